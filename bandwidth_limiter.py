@@ -0,0 +1,57 @@
+import datetime
+import threading
+import time
+
+
+class bandwidth_limiter:
+    """Limits the combined speed of all downloads in bytes per second.
+
+    The limit is looked up on every block, so changes of the schedule apply to downloads already running.
+    :param limit: bytes per second outside the schedule, None for unlimited.
+    :param schedule: list of (start, end, limit) with start and end as 'HH:MM' local times, a range whose
+        end is before its start spans midnight. The first range containing the current time applies.
+    """
+
+    def __init__(self, limit=None, schedule=()):
+        self.limit = limit
+        self.schedule = [(parse_time(start), parse_time(end), limit) for start, end, limit in schedule]
+        self.rate = None
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.throttled_seconds = 0
+        self.lock = threading.Lock()
+
+    def get_limit(self, now=None):
+        now = (now or datetime.datetime.now()).time()
+        for start, end, limit in self.schedule:
+            if start <= now < end or (end <= start and (now >= start or now < end)):
+                return limit
+
+        return self.limit
+
+    def consume(self, size):
+        """Account for size downloaded bytes, sleeping as long as needed to stay under the current limit."""
+        with self.lock:
+            rate = self.get_limit()
+            now = time.monotonic()
+            if rate != self.rate:
+                # Start the new limit afresh rather than carrying over a debt or credit of the old one.
+                self.rate, self.tokens = rate, 0
+            elif rate:
+                # At most a quarter of a second of unused bandwidth can be spent in a burst.
+                self.tokens = min(rate / 4, self.tokens + (now - self.updated_at) * rate)
+            self.updated_at = now
+
+            if not rate:
+                return
+
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+            self.throttled_seconds += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, '%H:%M').time()
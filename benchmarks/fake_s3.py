@@ -0,0 +1,243 @@
+"""A local stand-in for an S3 compatible object store (like MinIO), for the "s3" storage sink without a bucket.
+
+Implements the requests the sink makes with path-style addressing: objects (put, head, get, delete, server-side
+copy), multipart uploads (create, upload part, complete, abort, list) and list_objects_v2. Objects are held in memory
+and signatures are not checked, any bucket exists.
+
+Run on its own with `python benchmarks/fake_s3.py --port 9000` and set S3_ENDPOINT_URL to the printed URL, or
+through run_benchmarks.py --s3.
+"""
+import argparse
+import hashlib
+import re
+import threading
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class fake_s3_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, fake_s3_handler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+
+class fake_s3_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_):
+        pass
+
+    def parse(self):
+        url = urllib.parse.urlparse(self.path)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', '') or \
+                self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'):
+            return decode_aws_chunked(body)
+        return body
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        if not key:
+            return self.send_xml(200, '')
+
+        server = self.server
+        if 'uploadId' in query:
+            with server.lock:
+                parts = server.uploads.get((bucket, key, query['uploadId']))
+                if parts is None:
+                    return self.send_error_xml(404, 'NoSuchUpload')
+                parts[int(query['partNumber'])] = body
+            return self.send_xml(200, '', {'ETag': etag(body)})
+
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            source_bucket, _, source_key = urllib.parse.unquote(copy_source).lstrip('/').partition('/')
+            with server.lock:
+                data = server.objects.get((source_bucket, source_key))
+                if data is None:
+                    return self.send_error_xml(404, 'NoSuchKey')
+                server.objects[(bucket, key)] = data
+            return self.send_xml(200, f'<CopyObjectResult><ETag>{etag(data)}</ETag></CopyObjectResult>')
+
+        with server.lock:
+            server.objects[(bucket, key)] = body
+        self.send_xml(200, '', {'ETag': etag(body)})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        body = self.read_body()
+        server = self.server
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with server.lock:
+                server.uploads[(bucket, key, upload_id)] = {}
+            return self.send_xml(200, (
+                f'<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>'
+                f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+            ))
+
+        if 'uploadId' in query:
+            part_numbers = [
+                int(element.text) for element in ElementTree.fromstring(body).iter()
+                if element.tag.rsplit('}', 1)[-1] == 'PartNumber'
+            ]
+            with server.lock:
+                parts = server.uploads.pop((bucket, key, query['uploadId']), None)
+                if parts is None:
+                    return self.send_error_xml(404, 'NoSuchUpload')
+                if any(number not in parts for number in part_numbers):
+                    return self.send_error_xml(400, 'InvalidPart')
+                data = b''.join(parts[number] for number in part_numbers)
+                server.objects[(bucket, key)] = data
+            return self.send_xml(200, (
+                f'<CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>'
+                f'<ETag>{etag(data)}</ETag></CompleteMultipartUploadResult>'
+            ))
+
+        self.send_error_xml(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop((bucket, key, query['uploadId']), None)
+            else:
+                self.server.objects.pop((bucket, key), None)
+        self.send_xml(204, '')
+
+    def do_HEAD(self):
+        bucket, key, _ = self.parse()
+        with self.server.lock:
+            data = self.server.objects.get((bucket, key))
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag(data))
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if not key and 'uploads' in query:
+            return self.send_upload_list(bucket, query.get('prefix', ''))
+        if not key:
+            return self.send_list(bucket, query.get('prefix', ''))
+
+        with self.server.lock:
+            data = self.server.objects.get((bucket, key))
+        if data is None:
+            return self.send_error_xml(404, 'NoSuchKey')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_list(self, bucket, prefix):
+        with self.server.lock:
+            items = sorted(
+                (key, len(data)) for (item_bucket, key), data in self.server.objects.items()
+                if item_bucket == bucket and key.startswith(prefix)
+            )
+
+        contents = ''.join(f'<Contents><Key>{escape(key)}</Key><Size>{size}</Size></Contents>' for key, size in items)
+        self.send_xml(200, (
+            f'<ListBucketResult><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(items)}</KeyCount><IsTruncated>false</IsTruncated>{contents}</ListBucketResult>'
+        ))
+
+    def send_upload_list(self, bucket, prefix):
+        with self.server.lock:
+            uploads = sorted(
+                (key, upload_id) for item_bucket, key, upload_id in self.server.uploads
+                if item_bucket == bucket and key.startswith(prefix)
+            )
+
+        contents = ''.join(
+            f'<Upload><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></Upload>' for key, upload_id in uploads
+        )
+        self.send_xml(200, (
+            f'<ListMultipartUploadsResult><Bucket>{escape(bucket)}</Bucket><Prefix>{escape(prefix)}</Prefix>'
+            f'<IsTruncated>false</IsTruncated>{contents}</ListMultipartUploadsResult>'
+        ))
+
+    def send_error_xml(self, status, code):
+        self.send_xml(status, f'<Error><Code>{code}</Code><Message>{code}</Message></Error>')
+
+    def send_xml(self, status, body, headers=None):
+        data = (f'<?xml version="1.0" encoding="UTF-8"?>{add_namespace(body)}' if body else '').encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def add_namespace(body):
+    # Error responses of S3 have no namespace.
+    if body.startswith('<Error>'):
+        return body
+    return re.sub(r'^<(\w+)>', lambda match: f'<{match.group(1)} xmlns="{S3_NAMESPACE}">', body, count=1)
+
+
+def etag(data):
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+def decode_aws_chunked(body):
+    """The payload of a body in the aws-chunked encoding, as sent for streamed and checksummed uploads."""
+    data, offset = [], 0
+    while offset < len(body):
+        line_end = body.index(b'\r\n', offset)
+        size = int(body[offset:line_end].split(b';')[0], 16)
+        if not size:
+            break
+        data.append(body[line_end + 2:line_end + 2 + size])
+        offset = line_end + 2 + size + 2
+
+    return b''.join(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000, help='0 for any free port (default: %(default)s)')
+    args = parser.parse_args()
+
+    server = fake_s3_server((args.host, args.port))
+    print(server.base_url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
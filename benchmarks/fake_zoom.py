@@ -0,0 +1,327 @@
+"""A local stand-in for the Zoom API and its recording file CDN, serving synthetic accounts.
+
+Implements the endpoints zoom_client uses: the OAuth token, users (paginated with next_page_token), user
+recordings, meeting recordings and file downloads (with byte ranges). Every request needs a token issued by
+the OAuth endpoint that did not expire (after --token-lifetime seconds) and was not revoked, 401 responses are
+injected by revoking tokens. Latency, page sizes, 401 and 429 responses, dropped downloads and download speed
+can all be set, see --help.
+
+Run on its own with `python benchmarks/fake_zoom.py --port 8000`, or through run_benchmarks.py.
+"""
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK = bytes(range(256)) * 256
+
+
+class fake_account:
+    """Users with meetings spread evenly over a date range, each meeting with the same number of files."""
+
+    def __init__(self, users=10, meetings_per_user=20, files_per_meeting=2, file_size=1024 * 1024,
+                 start_date='2024-01-01', end_date='2024-12-31'):
+        self.users = [f'user{i}@example.com' for i in range(users)]
+        self.meetings_per_user = meetings_per_user
+        self.files_per_meeting = files_per_meeting
+        self.file_size = file_size
+        self.start_date = datetime.datetime.fromisoformat(start_date)
+        self.end_date = datetime.datetime.fromisoformat(end_date) + datetime.timedelta(days=1)
+
+    def get_meetings(self, user, base_url, from_date=None, to_date=None):
+        """Meetings of user that started from from_date and before the day after to_date."""
+        user_index = self.users.index(user)
+        step = (self.end_date - self.start_date) / max(1, self.meetings_per_user)
+        meetings = []
+        for i in range(self.meetings_per_user):
+            start_time = self.start_date + step * i
+            if from_date and start_time < from_date or to_date and start_time >= to_date:
+                continue
+            meetings.append(self.get_meeting(f'{user_index}-{i}', base_url, start_time))
+
+        return meetings
+
+    def get_meeting(self, uuid, base_url, start_time=None):
+        user_index, meeting_index = map(int, uuid.split('-'))
+        if start_time is None:
+            step = (self.end_date - self.start_date) / max(1, self.meetings_per_user)
+            start_time = self.start_date + step * meeting_index
+
+        start = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {
+            'uuid': uuid,
+            'id': user_index * 1_000_000 + meeting_index,
+            'host_email': self.users[user_index],
+            'topic': f'Meeting {meeting_index} of user {user_index}',
+            'start_time': start,
+            'recording_files': [
+                {
+                    'id': f'file-{uuid}-{k:08d}',
+                    'file_type': 'MP4',
+                    'file_extension': 'MP4',
+                    'file_size': self.file_size,
+                    'recording_start': start,
+                    'recording_type': 'shared_screen_with_speaker_view',
+                    'status': 'completed',
+                    'download_url': f'{base_url}/rec/download/file-{uuid}-{k:08d}',
+                }
+                for k in range(self.files_per_meeting)
+            ],
+        }
+
+
+class fake_zoom_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, account, latency=0.0, max_page_size=300, unauthorized_rate=0.0,
+                 throttle_rate=0.0, retry_after=1, disconnect_rate=0.0, bandwidth=None, token_lifetime=3600,
+                 seed=0):
+        super().__init__(address, fake_zoom_handler)
+        self.account = account
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.unauthorized_rate = unauthorized_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.disconnect_rate = disconnect_rate
+        self.bandwidth = bandwidth
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        # Issued tokens that were not revoked, with the time.monotonic() they expire at.
+        self.tokens = {}
+        self.rejected_at = 0
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def issue_token(self):
+        with self.lock:
+            token = f'token-{time.monotonic_ns()}'
+            self.tokens[token] = time.monotonic() + self.token_lifetime
+        return token
+
+    def check_token(self, token):
+        """Return whether token is valid, remembering when one was rejected."""
+        with self.lock:
+            if self.tokens.get(token, 0) > time.monotonic():
+                return True
+            self.rejected_at = time.monotonic()
+            return False
+
+    def revoke_token(self, token):
+        """Revoke token, unless a token was rejected in the last few seconds.
+
+        Clients retry a rejected call once, with a new token that may have been fetched by another thread.
+        Keeping tokens while rejected calls may still be retried, even after waiting on their rate limits,
+        lets that retry succeed as it does against Zoom.
+        """
+        with self.lock:
+            if token in self.tokens and time.monotonic() - self.rejected_at > self.latency + 5:
+                del self.tokens[token]
+
+
+class fake_zoom_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_):
+        pass
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path != '/oauth/token':
+            return self.send_json(404, {'code': 404, 'message': 'Not found'})
+
+        self.server.count('/oauth/token')
+        time.sleep(self.server.latency)
+        self.send_json(200, {'access_token': self.server.issue_token(), 'expires_in': self.server.token_lifetime})
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = urllib.parse.unquote(urllib.parse.unquote(url.path))
+        authorization = self.headers.get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else query.get('access_token')
+
+        if path.startswith('/rec/download/'):
+            self.server.count('/rec/download')
+            if not self.server.check_token(token):
+                return self.send_json(401, {'code': 124, 'message': 'Invalid access token.'})
+            return self.send_file(path.rsplit('/', 1)[1])
+
+        time.sleep(self.server.latency)
+        if not self.server.check_token(token):
+            return self.send_json(401, {'code': 124, 'message': 'Invalid access token.'})
+        if self.server.chance(self.server.unauthorized_rate):
+            # This request still succeeds, later ones with the token are rejected until a new one is fetched.
+            self.server.revoke_token(token)
+        if self.server.chance(self.server.throttle_rate):
+            return self.send_json(
+                429, {'code': 429, 'message': 'Too many requests.'},
+                {'Retry-After': str(self.server.retry_after), 'X-RateLimit-Category': 'Medium'},
+            )
+
+        account = self.server.account
+        if path == '/v2/users':
+            self.server.count('/v2/users')
+            return self.send_page('users', account.users if query.get('status', 'active') == 'active' else [],
+                                  query, lambda email: {'email': email, 'first_name': email.split('@')[0]})
+
+        match = re.fullmatch(r'/v2/users/([^/]+)/recordings', path)
+        if match and match.group(1) in account.users:
+            self.server.count('/v2/users/{id}/recordings')
+            from_date = datetime.datetime.fromisoformat(query['from'])
+            to_date = datetime.datetime.fromisoformat(query['to']) + datetime.timedelta(days=1)
+            meetings = account.get_meetings(match.group(1), self.server.base_url, from_date, to_date)
+            return self.send_page('meetings', meetings, query)
+
+        match = re.fullmatch(r'/v2/meetings/(\d+-\d+)/recordings', path)
+        if match:
+            self.server.count('/v2/meetings/{id}/recordings')
+            return self.send_json(200, account.get_meeting(match.group(1), self.server.base_url))
+
+        self.send_json(404, {'code': 1001, 'message': 'Not found.'})
+
+    def send_page(self, key, items, query, to_json=lambda item: item):
+        page_size = min(int(query.get('page_size', 30)), self.server.max_page_size)
+        offset = int(query.get('next_page_token') or 0)
+        next_offset = offset + page_size
+
+        self.send_json(200, {
+            'page_count': (len(items) + page_size - 1) // page_size,
+            'page_size': page_size,
+            'total_records': len(items),
+            'next_page_token': str(next_offset) if next_offset < len(items) else '',
+            key: [to_json(item) for item in items[offset:next_offset]],
+        })
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_file(self, file_id):
+        size = self.server.account.file_size
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+
+        # A dropped download stops somewhere in the middle of the body.
+        stop = end + 1
+        if self.server.chance(self.server.disconnect_rate):
+            with self.server.lock:
+                stop = start + self.server.random.randrange(end + 1 - start)
+
+        chunk_size = len(BLOCK)
+        started_at = time.monotonic()
+        offset = start
+        try:
+            while offset < stop:
+                # Every block of the file holds the same bytes, so files are never held in memory.
+                block_offset = offset % len(BLOCK)
+                chunk = BLOCK[block_offset:block_offset + min(chunk_size, stop - offset)]
+                self.wfile.write(chunk)
+                offset += len(chunk)
+
+                if self.server.bandwidth:
+                    ahead = (offset - start) / self.server.bandwidth - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            return
+
+        if stop <= end:
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+
+def add_server_arguments(parser):
+    group = parser.add_argument_group('fake Zoom account and server')
+    group.add_argument('--users', type=int, default=10, help='number of users (default: %(default)s)')
+    group.add_argument('--meetings-per-user', type=int, default=20, help='(default: %(default)s)')
+    group.add_argument('--files-per-meeting', type=int, default=2, help='(default: %(default)s)')
+    group.add_argument('--file-size', type=int, default=1024 * 1024, help='bytes (default: %(default)s)')
+    group.add_argument('--start-date', default='2024-01-01', help='first day of meetings (default: %(default)s)')
+    group.add_argument('--end-date', default='2024-12-31', help='last day of meetings (default: %(default)s)')
+    group.add_argument('--latency', type=float, default=0.0, help='seconds added to API calls (default: %(default)s)')
+    group.add_argument('--max-page-size', type=int, default=300, help='(default: %(default)s)')
+    group.add_argument('--unauthorized-rate', type=float, default=0.0,
+                       help='share of API calls that revoke their token, so the calls after them are answered '
+                            'with 401 until a new token is fetched (default: %(default)s)')
+    group.add_argument('--throttle-rate', type=float, default=0.0,
+                       help='share of API calls answered with 429 (default: %(default)s)')
+    group.add_argument('--retry-after', type=float, default=1, help='Retry-After of 429 responses (default: %(default)s)')
+    group.add_argument('--disconnect-rate', type=float, default=0.0,
+                       help='share of downloads dropped midway (default: %(default)s)')
+    group.add_argument('--bandwidth', type=int, default=None, help='bytes per second per download (default: no limit)')
+    group.add_argument('--token-lifetime', type=float, default=3600,
+                       help='seconds until an access token expires (default: %(default)s)')
+    group.add_argument('--seed', type=int, default=0, help='seed of the injected failures (default: %(default)s)')
+
+
+def create_server(args, host='127.0.0.1', port=0):
+    account = fake_account(
+        args.users, args.meetings_per_user, args.files_per_meeting, args.file_size, args.start_date, args.end_date
+    )
+    return fake_zoom_server(
+        (host, port), account, latency=args.latency, max_page_size=args.max_page_size,
+        unauthorized_rate=args.unauthorized_rate, throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        disconnect_rate=args.disconnect_rate, bandwidth=args.bandwidth, token_lifetime=args.token_lifetime,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000, help='0 for any free port (default: %(default)s)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(args, args.host, args.port)
+    print(server.base_url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Benchmarks of scanning and downloading against a local fake Zoom API (see fake_zoom.py), no Zoom account needed.
+
+Runs get_users, get_meeting_uuids, get_meetings and download_recordings (twice, the second time with every
+file already downloaded) of zoom_batch_downloader in a temporary folder, with a config.py made from
+config_template.py, and reports API calls per second, MB/s and peak RSS of each.
+
+    python benchmarks/run_benchmarks.py --users 20 --latency 0.05 --set MAX_CONCURRENT_DOWNLOADS=8
+
+Options not listed below (account size, latency, injected failures) are passed on to fake_zoom.py. With --s3
+files are stored with the "s3" storage sink in a local stand-in of S3 (see fake_s3.py) instead of on disk.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, ROOT_PATH)
+
+from zoom_client import timeout_http_adapter  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class redirect_adapter(timeout_http_adapter):
+    """Sends requests for api.zoom.us to the fake server instead."""
+
+    def __init__(self, base_url, *args, **kwargs):
+        self.base_url = base_url
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace('https://api.zoom.us', self.base_url, 1)
+        return super().send(request, **kwargs)
+
+
+def get_peak_rss():
+    """Peak resident set size of this process in bytes, None where it is not available."""
+    if not resource:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def start_server(script, *args):
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARKS_PATH, script), '--port', '0', *args], stdout=subprocess.PIPE, text=True,
+    )
+
+
+def read_server_url(server, name):
+    base_url = server.stdout.readline().strip()
+    if not base_url:
+        raise SystemExit(f'The fake {name} server did not start.')
+
+    return base_url
+
+
+def write_config(work_path, from_date, to_date, overrides):
+    with open(os.path.join(ROOT_PATH, 'config_template.py'), encoding='utf-8') as template:
+        config = template.read()
+
+    settings = {
+        'ACCOUNT_ID': repr('benchmark'),
+        'CLIENT_ID': repr('benchmark'),
+        'CLIENT_SECRET': repr('benchmark'),
+        'OUTPUT_PATH': repr(os.path.join(work_path, 'output')),
+        'USERS': '[]',
+        'START_YEAR': from_date[:4], 'START_MONTH': str(int(from_date[5:7])), 'START_DAY': str(int(from_date[8:10])),
+        'END_YEAR': to_date[:4], 'END_MONTH': str(int(to_date[5:7])), 'END_DAY': str(int(to_date[8:10])),
+        'PROGRESS_OUTPUT': repr('none'),
+        'RUN_REPORT_PATH': 'None',
+        'PROMETHEUS_TEXTFILE_PATH': 'None',
+    }
+    settings.update(overrides)
+
+    # Assignments at the end replace the ones of the template.
+    config += '\n# Benchmark settings\n' + ''.join(f'{name} = {value}\n' for name, value in settings.items())
+    with open(os.path.join(work_path, 'config.py'), 'w', encoding='utf-8') as file:
+        file.write(config)
+
+
+def run_stage(name, downloader, function, verbose):
+    requests_before = count_api_requests(downloader)
+    bytes_before = downloader.progress.snapshot()['bytes_done']
+
+    started_at = time.perf_counter()
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    seconds = time.perf_counter() - started_at
+
+    api_calls = count_api_requests(downloader) - requests_before
+    downloaded_bytes = downloader.progress.snapshot()['bytes_done'] - bytes_before
+
+    return result, {
+        'stage': name,
+        'seconds': round(seconds, 3),
+        'api_calls': api_calls,
+        'api_calls_per_second': round(api_calls / seconds, 1) if seconds else None,
+        'downloaded_bytes': downloaded_bytes,
+        'megabytes_per_second': round(downloaded_bytes / 2 ** 20 / seconds, 1) if seconds else None,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+def count_api_requests(downloader):
+    return sum(request['count'] for request in downloader.metrics.report()['api_requests'].values())
+
+
+def print_results(results):
+    print(f'{"stage":<32}{"seconds":>9}{"API calls":>11}{"calls/s":>10}{"MB":>10}{"MB/s":>9}{"peak RSS":>11}')
+    for result in results:
+        peak_rss = f'{result["peak_rss_bytes"] / 2 ** 20:.0f} MB' if result['peak_rss_bytes'] else '?'
+        print(
+            f'{result["stage"]:<32}{result["seconds"]:>9.2f}{result["api_calls"]:>11}'
+            f'{result["api_calls_per_second"] or 0:>10.1f}{result["downloaded_bytes"] / 2 ** 20:>10.1f}'
+            f'{result["megabytes_per_second"] or 0:>9.1f}{peak_rss:>11}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0], epilog='See fake_zoom.py --help for the other options.'
+    )
+    parser.add_argument('--from-date', default='2024-01-01', help='first day to scan (default: %(default)s)')
+    parser.add_argument('--to-date', default='2024-12-31', help='last day to scan (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='config.py setting for the benchmarks, as a Python expression, e.g. DOWNLOAD_SEGMENTS=8')
+    parser.add_argument('--s3', action='store_true',
+                        help='store the downloads in a local stand-in of S3 with the "s3" storage sink (needs boto3)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the output of zoom_batch_downloader')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder with the downloads')
+    args, server_args = parser.parse_known_args()
+
+    overrides = dict(setting.split('=', 1) for setting in args.set)
+    server_args += ['--start-date', args.from_date, '--end-date', args.to_date]
+
+    servers = [start_server('fake_zoom.py', *server_args)]
+    if args.s3:
+        servers.append(start_server('fake_s3.py'))
+    work_path = tempfile.mkdtemp(prefix='zoom-batch-downloader-benchmark-')
+    try:
+        base_url = read_server_url(servers[0], 'Zoom')
+        if args.s3:
+            s3_settings = {
+                'STORAGE_SINK': repr('s3'),
+                'S3_BUCKET': repr('benchmark'),
+                'S3_ENDPOINT_URL': repr(read_server_url(servers[1], 'S3')),
+                'S3_REGION': repr('us-east-1'),
+                'S3_ACCESS_KEY_ID': repr('benchmark'),
+                'S3_SECRET_ACCESS_KEY': repr('benchmark'),
+            }
+            overrides = dict(s3_settings, **overrides)
+
+        write_config(work_path, args.from_date, args.to_date, overrides)
+        os.chdir(work_path)
+        sys.path.insert(0, work_path)
+        import zoom_batch_downloader as downloader
+        downloader.setup()
+
+        adapter = redirect_adapter(
+            base_url, downloader.client.session.get_adapter('https://api.zoom.us').timeout,
+            pool_connections=downloader.CONFIG.HTTP_POOL_SIZE, pool_maxsize=downloader.CONFIG.HTTP_POOL_SIZE,
+        )
+        downloader.client.session.mount('https://api.zoom.us', adapter)
+
+        from_date = datetime.datetime.fromisoformat(args.from_date)
+        to_date = datetime.datetime.fromisoformat(args.to_date)
+        results = []
+
+        users, result = run_stage('get_users', downloader, downloader.get_users, args.verbose)
+        results.append(result)
+
+        meeting_uuids, result = run_stage('get_meeting_uuids', downloader, lambda: [
+            uuid
+            for user_email, _ in users
+            for uuid in downloader.get_meeting_uuids(user_email, from_date, to_date, show_progress=False)
+        ], args.verbose)
+        results.append(result)
+
+        _, result = run_stage(
+            'get_meetings', downloader,
+            lambda: downloader.get_meetings(meeting_uuids, show_progress=False), args.verbose
+        )
+        results.append(result)
+
+        for stage in ('download_recordings', 'download_recordings (skipped)'):
+            _, result = run_stage(
+                stage, downloader, lambda: downloader.download_recordings(users, from_date, to_date), args.verbose
+            )
+            results.append(result)
+
+        downloader.database.close()
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        os.chdir(ROOT_PATH)
+        if not args.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+        if args.keep:
+            print(f'Downloads kept in {work_path}')
+
+
+if __name__ == '__main__':
+    main()
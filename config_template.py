@@ -7,6 +7,17 @@ CLIENT_SECRET = R"##########"
 # Insert non ready files flag here, if it's true only files that were not ready during last runtime will be downloaded.
 NOT_READY_FILES_ONLY = False
 
+# Meetings that were not ready are retried after NOT_READY_RETRY_DELAY seconds, doubling the delay after every
+# failed attempt, up to NOT_READY_MAX_ATTEMPTS attempts. Due meetings are retried NOT_READY_BATCH_SIZE at a time.
+NOT_READY_RETRY_DELAY = 15 * 60
+NOT_READY_MAX_ATTEMPTS = 10
+NOT_READY_BATCH_SIZE = 100
+
+
+# If True, files downloaded earlier are hashed again and compared with the SHA-256 computed while downloading
+# them, nothing is downloaded.
+VERIFY_FILES_ONLY = False
+
 
 # Put your own download path here, no need to escape backslashes but avoid ending with one.
 OUTPUT_PATH = R"C:\Test\Zoom"
@@ -54,7 +65,89 @@ GROUP_BY_RECORDING = False
 # This works when "Record a separate audio file of each participant" is enabled.
 INCLUDE_PARTICIPANT_AUDIO = True
 
-# Set to True for more verbose output.
+# Number of recording files downloaded at the same time. 1 downloads files one by one.
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# Maximum number of files downloaded at the same time from a single user, None for no per-user limit.
+MAX_CONCURRENT_DOWNLOADS_PER_USER = None
+
+# Number of kept-alive connections per host (Zoom API and download servers), shared by all threads.
+# Should be at least MAX_CONCURRENT_DOWNLOADS times DOWNLOAD_SEGMENTS if segmented downloads are enabled.
+HTTP_POOL_SIZE = 16
+
+# Seconds to wait for a connection to be established and between bytes received from the server.
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# Number of Zoom API requests (e.g. looking up the recordings of a meeting) sent at the same time.
+MAX_CONCURRENT_API_REQUESTS = 8
+
+# Number of users scanned for recordings at the same time. Downloads still follow the order of the users.
+MAX_CONCURRENT_USER_SCANS = 2
+
+# Zoom API requests per second for each rate limit category, see https://developers.zoom.us/docs/api/rest/rate-limits/
+# These are the limits of Pro accounts, Business and larger accounts can raise them (e.g. 80/60/40).
+# Requests are paced to stay below these and slow down automatically when Zoom answers with 429.
+API_RATE_LIMITS = {"light": 30, "medium": 20, "heavy": 10}
+
+# If True, recording files are taken straight from the user recordings list, and meetings are only looked
+# up one by one when the list is missing something (e.g. files still being processed). This saves about
+# one API call per meeting, but only when INCLUDE_PARTICIPANT_AUDIO is False since the list does not
+# include participant audio files.
+SINGLE_PASS_SCAN = True
+
+# If True, scanned meetings are kept in meetings.db and later runs only list dates from the last fully
+# scanned date of each user (minus INCREMENTAL_SYNC_LOOKBACK_DAYS, for recordings that were still being
+# processed), taking older meetings from meetings.db.
+INCREMENTAL_SYNC = False
+INCREMENTAL_SYNC_LOOKBACK_DAYS = 3
+
+# If True, the downloaded files recorded in meetings.db are checked against the files in OUTPUT_PATH before
+# downloading, for when files were moved or deleted by hand. Files recorded in meetings.db are otherwise
+# skipped without being looked up in OUTPUT_PATH.
+RECONCILE_MANIFEST = False
+
+# If True, a file whose content was already downloaded to another path (e.g. the same meeting under two users
+# with GROUP_BY_USER) is stored as a hard link to the existing file instead of a second copy. With the "s3"
+# STORAGE_SINK it is copied within the bucket instead of being downloaded again.
+DEDUPLICATE_FILES = False
+
+# How the progress of downloads is shown: "terminal" for a status line with the files, bytes, speed and
+# estimated time left of the whole run, "json" for the same as a JSON object per line every
+# PROGRESS_JSON_INTERVAL seconds (e.g. for logs of scheduled runs), "none", or "auto" for "terminal" when
+# the output is a terminal and "json" otherwise.
+PROGRESS_OUTPUT = "auto"
+PROGRESS_JSON_INTERVAL = 30
+
+# Path of a JSON report written at the end of every run, with the time spent in each phase (summed over threads,
+# and from its first start to its last end), API request counts and latencies per endpoint, retries, token
+# refreshes, waits and bytes downloaded per user. None to disable.
+RUN_REPORT_PATH = "run_report.json"
+
+# Path of the same metrics in the Prometheus text format, e.g. in the folder of the textfile collector of
+# the node exporter ("/var/lib/node_exporter/textfile_collector/zoom_batch_downloader.prom"). None to disable.
+PROMETHEUS_TEXTFILE_PATH = None
+
+# Path of a database shared by several processes or hosts that split the users of a backfill between them,
+# None to download every user in this process. Each worker leases users one at a time and keeps renewing the
+# leases while it works on them. If a worker stops (crash, lost network), its users are taken over by another
+# worker SHARD_LEASE_SECONDS later, resuming partial files when OUTPUT_PATH is shared. Users done are not
+# leased again for the same dates. For several hosts, put it on a share with working file locks (e.g. NFS
+# or SMB, not a synced folder like Dropbox or Google Drive) and keep their clocks in sync.
+SHARD_DATABASE_PATH = None
+SHARD_LEASE_SECONDS = 300
+
+# Path of a Chrome trace (JSON) of the run, with a span for every user, date window, meeting lookup and file
+# download on the thread that ran it. Open it in chrome://tracing or https://ui.perfetto.dev to see where
+# time is spent and where threads sit idle. None to disable.
+TRACE_PATH = None
+
+# Path of cProfile statistics of the run, sorted by PROFILE_SORT (e.g. "cumulative" or "tottime"). The raw
+# statistics are also written next to it with a .prof extension, e.g. for snakeviz. None to disable.
+PROFILE_PATH = None
+PROFILE_SORT = "cumulative"
+
+# Set to True for more verbose output (including a progress bar for every file).
 VERBOSE_OUTPUT = False
 
 # Constants used for indicating size in bytes.
@@ -65,7 +158,7 @@ GB = 1024 * MB
 TB = 1024 * GB
 
 # Minimum free disk space in bytes for downloads to happen, downloading will be stalled if disk space is
-# expected to get below this amount as a result of the new file.
+# expected to get below this amount as a result of the new file and the other downloads in progress.
 MINIMUM_FREE_DISK = 1 * GB
 
 # Tolerance for recording files size mismatch between the declared size in Zoom Servers and the files
@@ -73,3 +166,49 @@ MINIMUM_FREE_DISK = 1 * GB
 # This was observed to happen sometimes on google drive mounted storage (mismatches of < 300 KBs).
 # Note: High tolerance might cause issues like corrupt downloads not being recognized by script.
 FILE_SIZE_MISMATCH_TOLERANCE = 0 * KB
+
+# Files of at least this size in bytes are downloaded as DOWNLOAD_SEGMENTS byte ranges over parallel
+# connections, which helps when a single connection is slower than your link. None to disable (e.g. 1 * GB to enable).
+SEGMENTED_DOWNLOAD_THRESHOLD = None
+DOWNLOAD_SEGMENTS = 4
+
+# Size in bytes of the chunks downloads are read and written in, larger chunks use less CPU on fast links.
+DOWNLOAD_CHUNK_SIZE = 1 * MB
+
+# When downloaded files are flushed to disk: "file" once each file is complete, "chunk" after every chunk
+# (slower, but a crash loses no downloaded bytes) or "never" (left to the operating system).
+FSYNC_DOWNLOADS = "file"
+
+# Downloads slower than STALLED_DOWNLOAD_SPEED bytes per second for STALLED_DOWNLOAD_WINDOW seconds are aborted
+# and retried (resuming where they stopped). None to only rely on HTTP_READ_TIMEOUT.
+STALLED_DOWNLOAD_SPEED = 10 * KB
+STALLED_DOWNLOAD_WINDOW = 120
+
+# Limit of the combined speed of all downloads in bytes per second (e.g. 50 * MB), None for no limit.
+DOWNLOAD_SPEED_LIMIT = None
+
+# Limits by time of day that replace DOWNLOAD_SPEED_LIMIT, as ("HH:MM", "HH:MM", limit) ranges in local time.
+# A range ending before it starts spans midnight. Changes apply to downloads in progress, e.g. to limit
+# downloads during working hours and run at full speed at night: [("08:00", "20:00", 50 * MB)]
+DOWNLOAD_SPEED_SCHEDULE = []
+
+# Where downloaded files are stored: "local" for files under OUTPUT_PATH, or "s3" to stream them straight into an
+# S3 compatible bucket (AWS S3, MinIO, ...) without writing them to disk, which needs boto3
+# (python -m pip install boto3). The key of an object is the path of the file relative to OUTPUT_PATH, under S3_PREFIX.
+STORAGE_SINK = "local"
+
+# Bucket of the "s3" sink. S3_ENDPOINT_URL is only needed for services other than AWS (e.g. "http://localhost:9000"
+# for MinIO). The region and keys default to the usual AWS configuration (environment variables,
+# ~/.aws/credentials, ...) when None.
+S3_BUCKET = ""
+S3_PREFIX = ""
+S3_ENDPOINT_URL = None
+S3_REGION = None
+S3_ACCESS_KEY_ID = None
+S3_SECRET_ACCESS_KEY = None
+
+# Size of the parts of S3 multipart uploads (at least 5 MB). Each download holds up to two parts in memory, a file
+# is only stored in the bucket once it was downloaded completely with the expected size. The unfinished upload of a
+# killed run is aborted when its file is downloaded again, a lifecycle rule with AbortIncompleteMultipartUpload
+# (e.g. after 7 days) on the bucket also removes those of files that never are.
+S3_PART_SIZE = 16 * MB
@@ -0,0 +1,76 @@
+import contextlib
+import os
+import shutil
+import threading
+import time
+
+import utils
+
+
+class disk_space_ledger:
+    """Reserves disk space for the downloads in flight, so concurrent downloads can't overfill the volume.
+    All files are expected to be on the same volume (the one of OUTPUT_PATH).
+
+    Free disk space only shrinks as the files get written, so every reservation counts the bytes of its file
+    that are not allocated on disk yet as already used. Downloads waiting for space are woken up as soon as
+    a reservation is released, and every recheck_interval seconds in case other programs freed some space.
+    """
+
+    def __init__(self, minimum_free_disk, recheck_interval=30):
+        self.minimum_free_disk = minimum_free_disk
+        self.recheck_interval = recheck_interval
+        self.reservations = {}
+        self.condition = threading.Condition()
+        self.waited_seconds = 0
+
+    @contextlib.contextmanager
+    def reserve(self, file_path, file_size):
+        """Wait until file_size bytes can be written to file_path, keeping them reserved until the block exits."""
+        with self.condition:
+            notified = False
+            started_at = time.monotonic()
+            while not self._fits(file_path, file_size):
+                # Reported when starting to wait and on every recheck, not every time a download completes.
+                if not notified:
+                    self._print_waiting(file_path, file_size)
+                notified = self.condition.wait(self.recheck_interval)
+
+            self.waited_seconds += time.monotonic() - started_at
+            self.reservations[file_path] = file_size
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                del self.reservations[file_path]
+                self.condition.notify_all()
+
+    def _fits(self, file_path, file_size):
+        reserved = sum(get_unallocated_size(path, size) for path, size in self.reservations.items())
+        free_disk = shutil.disk_usage(os.path.dirname(file_path)).free - reserved
+
+        return free_disk >= get_unallocated_size(file_path, file_size) + self.minimum_free_disk
+
+    def _print_waiting(self, file_path, file_size):
+        free_disk = shutil.disk_usage(os.path.dirname(file_path)).free
+        reserved = sum(get_unallocated_size(path, size) for path, size in self.reservations.items())
+
+        utils.print_bright_red(
+            f'Waiting for disk space... '
+            f'(File size: {utils.size_to_string(file_size)}, '
+            f'minimum free disk space: {utils.size_to_string(self.minimum_free_disk)}, '
+            f'available: {utils.size_to_string(free_disk)}, '
+            f'reserved by {len(self.reservations)} downloads in progress: {utils.size_to_string(reserved)})'
+        )
+
+
+def get_unallocated_size(file_path, file_size):
+    """Bytes of a file_size file at file_path that are not allocated on disk yet, e.g. of a partial download."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return file_size
+
+    # st_blocks includes preallocated blocks past the end of the file, it is missing on Windows.
+    allocated = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+    return max(0, file_size - allocated)
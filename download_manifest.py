@@ -0,0 +1,56 @@
+import datetime
+
+
+class download_manifest:
+    """Records downloaded recording files by their Zoom file ID, so files that are already downloaded can be
+    skipped without touching the output folder (which can be slow on network storage).
+
+    A recording file can be stored at more than one path (e.g. a meeting shared by users with GROUP_BY_USER),
+    each path has its own entry. Entries hold the SHA-256 of the file when it was downloaded by this script.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get(self, file_id):
+        """Return the (path, size, sha256) of every copy of the file."""
+        return self.storage.query(
+            "SELECT path, size, sha256 FROM downloaded_files WHERE id = ?", (file_id,)
+        )
+
+    def find_by_hash(self, sha256):
+        """Return the (path, size) of every file with the given content."""
+        return self.storage.query(
+            "SELECT path, size FROM downloaded_files WHERE sha256 = ?", (sha256,)
+        )
+
+    def get_hashed_files(self):
+        """Return the (path, size, sha256) of every file downloaded with a known hash."""
+        return self.storage.query(
+            "SELECT path, size, sha256 FROM downloaded_files WHERE sha256 IS NOT NULL"
+        )
+
+    def add(self, file_id, path, size, sha256=None):
+        self.storage.write(
+            "INSERT OR REPLACE INTO downloaded_files (id, path, size, sha256, completed_at) VALUES (?, ?, ?, ?, ?)",
+            (file_id, path, size, sha256, datetime.datetime.now().isoformat(timespec="seconds")),
+        )
+
+    def reconcile(self, file_sizes):
+        """Remove entries of files that are no longer stored or changed size.
+
+        The stored files are listed once (e.g. walking the folder tree with os.scandir) instead of checking each
+        entry on its own.
+        :param file_sizes: (path, size) of every stored file, see scan_file_sizes of the sinks.
+        :return: tuple of the number of entries checked and the number of entries removed.
+        """
+        sizes = dict(file_sizes)
+
+        with self.storage.lock:
+            rows = self.storage.query("SELECT id, path, size FROM downloaded_files")
+            stale_entries = [(file_id, path) for file_id, path, size in rows if sizes.get(path) != size]
+            self.storage.write_many("DELETE FROM downloaded_files WHERE id = ? AND path = ?", stale_entries)
+            self.storage.commit()
+
+        return len(rows), len(stale_entries)
+
@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict, deque
+
+
+class download_pool:
+    """Runs download jobs on a fixed set of worker threads.
+
+    Jobs are queued per user so that an optional per-user cap can be honored without
+    blocking workers that could serve other users. Queued and completed files are counted
+    in progress (a progress_tracker), whose status line stays on the first line, and every
+    worker owns the line below it (1..N) for its per-file bar, so concurrent downloads do
+    not overwrite each other.
+    With a single worker, jobs run inline on the calling thread, as they always have.
+    Once max_queued jobs are waiting for a worker, submit blocks until one is taken.
+    Leaving the pool on an error (or Ctrl-C) cancels the queued jobs and sets the cancelled event given to
+    the running ones, so they stop rather than finish their files.
+    """
+
+    def __init__(self, max_workers=1, max_workers_per_user=None, max_queued=None, progress=None):
+        self.max_workers = max(1, max_workers or 1)
+        self.max_workers_per_user = max_workers_per_user
+        self.max_queued = max_queued or 4 * self.max_workers
+        self.file_count, self.total_size, self.skipped_count = 0, 0, 0
+
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._active = {}
+        self._closed = False
+        self._error = None
+        self.cancelled = threading.Event()
+        self._workers = []
+        self.progress = progress
+
+        if self.is_concurrent():
+            for position in range(1, self.max_workers + 1):
+                worker = threading.Thread(target=self._work, args=(position,), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.join()
+        else:
+            self.cancel()
+
+    def is_concurrent(self):
+        return self.max_workers > 1
+
+    def submit(self, user, download, file_size):
+        """Queue `download(position, cancelled=...)`, which returns True when the file was downloaded
+        and False when it was skipped (None when it failed, counted as skipped)."""
+
+        if self.progress:
+            self.progress.add_file(file_size)
+
+        if not self.is_concurrent():
+            self._record(download(None, cancelled=self.cancelled), file_size)
+            return
+
+        with self._condition:
+            while self._queued() >= self.max_queued and not self._error:
+                self._condition.wait()
+
+            self._raise_error()
+            self._pending.setdefault(user, deque()).append((download, file_size))
+            self._condition.notify_all()
+
+    def join(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        try:
+            for worker in self._workers:
+                worker.join()
+        except BaseException:
+            # Interrupted while waiting for the workers (Ctrl-C), their downloads are cancelled too.
+            self.cancel()
+            raise
+
+        self._raise_error()
+        return self.file_count, self.total_size, self.skipped_count
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._condition:
+            self._pending.clear()
+            self._closed = True
+            self._condition.notify_all()
+
+    def _work(self, position):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    if self._closed and not self._pending:
+                        return
+                    self._condition.wait()
+                    job = self._next_job()
+
+            user, (download, file_size) = job
+            try:
+                self._record(download(position, cancelled=self.cancelled), file_size)
+            except BaseException as error:
+                with self._condition:
+                    self._error = self._error or error
+                    self._pending.clear()
+            finally:
+                with self._condition:
+                    self._active[user] -= 1
+                    self._condition.notify_all()
+
+    def _queued(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def _next_job(self):
+        for user, jobs in self._pending.items():
+            if self.max_workers_per_user and self._active.get(user, 0) >= self.max_workers_per_user:
+                continue
+
+            job = jobs.popleft()
+            if not jobs:
+                del self._pending[user]
+
+            self._active[user] = self._active.get(user, 0) + 1
+            return user, job
+
+        return None
+
+    def _record(self, downloaded, file_size):
+        with self._condition:
+            if downloaded:
+                self.file_count += 1
+                self.total_size += file_size
+            else:
+                self.skipped_count += 1
+
+            if self.progress:
+                self.progress.file_done(file_size, downloaded)
+
+    def _raise_error(self):
+        if self._error:
+            raise self._error
@@ -0,0 +1,65 @@
+import datetime
+import json
+
+
+class metadata_cache:
+    """Keeps scanned users, meetings and recording files in SQLite so later runs can skip listing
+    date ranges that were already fully scanned (see get_synced_range)."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_synced_range(self, user_email):
+        """Dates (inclusive) for which all recordings of the user are in the cache, or None."""
+        rows = self.storage.query(
+            "SELECT synced_from, synced_through FROM users WHERE email = ?", (user_email,)
+        )
+        row = rows[0] if rows else None
+
+        if not row or not row[0] or not row[1]:
+            return None
+
+        return tuple(datetime.datetime.strptime(date, "%Y-%m-%d") for date in row)
+
+    def set_synced_range(self, user_email, user_name, synced_from, synced_through):
+        self.storage.write(
+            "INSERT INTO users (email, name, synced_from, synced_through) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (email) DO UPDATE SET name = excluded.name, "
+            "synced_from = excluded.synced_from, synced_through = excluded.synced_through",
+            (user_email, user_name, date_to_str(synced_from), date_to_str(synced_through)),
+        )
+
+    def get_meetings(self, user_email, from_date, before_date):
+        """Cached meetings of the user that started from from_date and before before_date, in chronological order."""
+        rows = self.storage.query(
+            "SELECT data FROM cached_meetings WHERE user_email = ? AND start_time >= ? AND start_time < ? "
+            "ORDER BY start_time",
+            (user_email, date_to_str(from_date), date_to_str(before_date)),
+        )
+
+        return [json.loads(row[0]) for row in rows]
+
+    def save_meeting(self, user_email, meeting):
+        recording_files = (meeting.get("recording_files") or []) + (meeting.get("participant_audio_files") or [])
+
+        with self.storage.lock:
+            self.storage.write(
+                "INSERT OR REPLACE INTO cached_meetings (uuid, user_email, start_time, topic, data) VALUES (?, ?, ?, ?, ?)",
+                (meeting["uuid"], user_email, meeting.get("start_time", ""), meeting.get("topic"), json.dumps(meeting)),
+            )
+            self.storage.write_many(
+                "INSERT OR REPLACE INTO recording_files "
+                "(id, meeting_uuid, file_type, file_size, recording_start, download_url) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        recording_file["id"], meeting["uuid"], recording_file.get("file_type"),
+                        recording_file.get("file_size"), recording_file.get("recording_start"),
+                        recording_file.get("download_url"),
+                    )
+                    for recording_file in recording_files if "id" in recording_file
+                ],
+            )
+
+
+def date_to_str(date):
+    return date.strftime("%Y-%m-%d")
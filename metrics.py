@@ -0,0 +1,178 @@
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Upper bounds in seconds of the buckets of the API latency histograms.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PROMETHEUS_PREFIX = "zoom_batch_downloader"
+
+
+class run_metrics:
+    """Counts and timings of a run, written as a JSON report and optionally a Prometheus textfile.
+
+    Phases run concurrently (users are scanned while files download) and on several threads each. The thread
+    seconds of a phase are the time spent in it summed over all threads, its span seconds the wall time from
+    its first start to its last end, so thread seconds / span seconds is roughly its average concurrency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.outcome = "failed"
+        self.phase_thread_seconds = defaultdict(float)
+        # (first start, last end) of every phase, in time.monotonic() seconds.
+        self.phase_spans = {}
+        self.counters = defaultdict(int)
+        self.requests = defaultdict(lambda: {"count": 0, "seconds": 0.0, "statuses": defaultdict(int),
+                                             "buckets": [0] * len(LATENCY_BUCKETS)})
+        self.users = defaultdict(lambda: {"files": 0, "bytes": 0, "seconds": 0.0})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, started_at, time.monotonic())
+
+    def add_phase_time(self, name, started_at, finished_at):
+        """Account for a thread spending from started_at to finished_at (time.monotonic()) in phase name."""
+        with self.lock:
+            self.phase_thread_seconds[name] += finished_at - started_at
+            first_start, last_end = self.phase_spans.get(name, (started_at, finished_at))
+            self.phase_spans[name] = (min(first_start, started_at), max(last_end, finished_at))
+
+    def increment(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def observe_request(self, endpoint, seconds, status):
+        with self.lock:
+            request = self.requests[endpoint]
+            request["count"] += 1
+            request["seconds"] += seconds
+            request["statuses"][str(status)] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    request["buckets"][i] += 1
+
+    def observe_download(self, user, size, seconds):
+        with self.lock:
+            user_downloads = self.users[user or ""]
+            user_downloads["files"] += 1
+            user_downloads["bytes"] += size
+            user_downloads["seconds"] += seconds
+
+    def report(self, **extra):
+        """The metrics as a JSON serializable dict, extra items (e.g. counts of other objects) are added as is."""
+        with self.lock:
+            finished_at = time.time()
+            report = {
+                "outcome": self.outcome,
+                "started_at": format_timestamp(self.started_at),
+                "finished_at": format_timestamp(finished_at),
+                "duration_seconds": round(finished_at - self.started_at, 3),
+                "phase_thread_seconds": {
+                    name: round(seconds, 3) for name, seconds in self.phase_thread_seconds.items()
+                },
+                "phase_span_seconds": {
+                    name: round(last_end - first_start, 3) for name, (first_start, last_end) in self.phase_spans.items()
+                },
+                "counters": dict(self.counters),
+                "api_requests": {
+                    endpoint: {
+                        "count": request["count"],
+                        "seconds": round(request["seconds"], 3),
+                        "statuses": dict(request["statuses"]),
+                        "latency_buckets": dict(zip(map(str, LATENCY_BUCKETS), request["buckets"])),
+                    }
+                    for endpoint, request in self.requests.items()
+                },
+                "users": {
+                    user: dict(
+                        downloads,
+                        seconds=round(downloads["seconds"], 3),
+                        bytes_per_second=round(downloads["bytes"] / downloads["seconds"]) if downloads["seconds"] else None,
+                    )
+                    for user, downloads in self.users.items()
+                },
+            }
+
+        report.update(extra)
+        return report
+
+    def write_json(self, path, report):
+        write_atomically(path, json.dumps(report, indent=2))
+
+    def write_prometheus(self, path, report):
+        """Write report in the text format of the Prometheus node exporter textfile collector."""
+        lines = []
+
+        def metric(name, metric_type, help, samples):
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for suffix, labels, value in samples:
+                label_str = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_str}}} {value}" if label_str else f"{name}{suffix} {value}")
+
+        metric("last_run_timestamp_seconds", "gauge", "Time the last run finished.", [("", {}, time.time())])
+        metric("last_run_duration_seconds", "gauge", "Wall time of the last run.", [("", {}, report["duration_seconds"])])
+        metric("last_run_success", "gauge", "1 if the last run completed.", [("", {}, int(report["outcome"] == "completed"))])
+        metric("phase_thread_seconds", "gauge", "Time spent in each phase, summed over threads.", [
+            ("", {"phase": name}, seconds) for name, seconds in report["phase_thread_seconds"].items()
+        ])
+        metric("phase_span_seconds", "gauge", "Wall time from the first start to the last end of each phase.", [
+            ("", {"phase": name}, seconds) for name, seconds in report["phase_span_seconds"].items()
+        ])
+        metric("events", "gauge", "Retries, token refreshes and other events of the last run.", [
+            ("", {"event": name}, count) for name, count in report["counters"].items()
+        ])
+        metric("api_requests", "gauge", "API requests by endpoint and HTTP status.", [
+            ("", {"endpoint": endpoint, "status": status}, count)
+            for endpoint, request in report["api_requests"].items()
+            for status, count in request["statuses"].items()
+        ])
+
+        samples = []
+        for endpoint, request in report["api_requests"].items():
+            samples += [
+                ("_bucket", {"endpoint": endpoint, "le": bound}, count)
+                for bound, count in request["latency_buckets"].items()
+            ]
+            samples += [
+                ("_bucket", {"endpoint": endpoint, "le": "+Inf"}, request["count"]),
+                ("_sum", {"endpoint": endpoint}, request["seconds"]),
+                ("_count", {"endpoint": endpoint}, request["count"]),
+            ]
+        metric("api_request_duration_seconds", "histogram", "Latency of API requests.", samples)
+
+        metric("downloaded_bytes", "gauge", "Bytes downloaded per user.", [
+            ("", {"user": user}, downloads["bytes"]) for user, downloads in report["users"].items()
+        ])
+        metric("download_seconds", "gauge", "Time spent downloading per user, summed over threads.", [
+            ("", {"user": user}, downloads["seconds"]) for user, downloads in report["users"].items()
+        ])
+
+        write_atomically(path, "\n".join(lines) + "\n")
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).astimezone().isoformat(timespec="seconds")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def write_atomically(path, text):
+    """Write text to path through a temporary file, so readers (like the textfile collector) never see half of it."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
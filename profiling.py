@@ -0,0 +1,120 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+from metrics import write_atomically
+
+NO_SPAN = contextlib.nullcontext()
+
+
+class run_profiler:
+    """Profiles the block with cProfile and writes the stats sorted by sort_key, both as text to path and
+    in the binary pstats format next to it (.prof, for tools like snakeviz). Does nothing when path is None.
+
+    Threads started in the block are profiled too, their stats are merged with those of the calling thread.
+    Before Python 3.12 every thread has its own profile, which can only be disabled by that thread, so only
+    those of threads that finished are merged. Threads still running at the end (e.g. idle background
+    threads) are listed at the top of the text output instead.
+    """
+
+    def __init__(self, path, sort_key="cumulative"):
+        self.path = path
+        self.sort_key = sort_key
+        self.profile = None
+        # (thread, profile) of the threads started in the block.
+        self.thread_profiles = []
+
+    def __enter__(self):
+        if not self.path:
+            return self
+
+        if sys.version_info < (3, 12):
+            # Before Python 3.12 a profile only sees the thread that enabled it, so every new thread enables its own.
+            threading.setprofile(self._profile_thread)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *_):
+        if not self.path:
+            return
+
+        threading.setprofile(None)
+        self.profile.disable()
+
+        # The profile of a running thread is still being written to, a finished thread no longer touches it.
+        profiles = [self.profile] + [profile for thread, profile in self.thread_profiles if not thread.is_alive()]
+        running = [thread.name for thread, _ in self.thread_profiles if thread.is_alive()]
+
+        with open(self.path, "w", encoding="utf-8") as file:
+            if running:
+                file.write(f"Not included, threads still running: {', '.join(running)}\n\n")
+            stats = pstats.Stats(*profiles, stream=file)
+            stats.sort_stats(self.sort_key).print_stats()
+        stats.dump_stats(os.path.splitext(self.path)[0] + ".prof")
+
+    def _profile_thread(self, *_):
+        # Called by the first profiler event of a new thread, enabling the profile replaces this hook.
+        profile = cProfile.Profile()
+        self.thread_profiles.append((threading.current_thread(), profile))
+        profile.enable()
+
+
+class trace_recorder:
+    """Records spans of work (users, date windows, meeting lookups, file downloads) on the thread running
+    them, written in the Chrome trace event format for chrome://tracing or https://ui.perfetto.dev.
+
+    Gaps between spans of a thread are time spent waiting, e.g. a download worker without queued files.
+    Spans cost next to nothing while the recorder is disabled.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+
+    def span(self, name, category="run", **args):
+        """Context manager recording the block as a span, with args (e.g. the file name) shown with it."""
+        if not self.enabled:
+            return NO_SPAN
+
+        return self._span(name, category, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, category, args):
+        thread = threading.current_thread()
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished_at = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((started_at - self.started_at) * 1e6, 1),
+                "dur": round((finished_at - started_at) * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": thread.native_id,
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+                self.thread_names[thread.native_id] = thread.name
+
+    def write(self, path):
+        with self.lock:
+            events = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+            events += self.events
+
+        write_atomically(path, json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
@@ -0,0 +1,157 @@
+import datetime
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from tqdm import tqdm
+
+# Modes of progress_reporter.
+PROGRESS_AUTO = "auto"
+PROGRESS_TERMINAL = "terminal"
+PROGRESS_JSON = "json"
+PROGRESS_NONE = "none"
+
+
+class progress_tracker:
+    """Files and bytes of a whole run, across users and concurrent downloads.
+
+    Files are added as they are queued, so the totals grow while users are still being scanned.
+    """
+
+    def __init__(self, rate_window=20):
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.user, self.users_done, self.users_total = None, 0, None
+        self.files_total, self.files_done, self.files_skipped = 0, 0, 0
+        self.bytes_total, self.bytes_done = 0, 0
+        self.samples = deque([(self.started_at, 0)])
+
+    def start_user(self, user, users_total=None):
+        with self.lock:
+            self.user = user
+            self.users_total = users_total or self.users_total
+
+    def user_done(self):
+        with self.lock:
+            self.user = None
+            self.users_done += 1
+
+    def add_file(self, file_size):
+        with self.lock:
+            self.files_total += 1
+            self.bytes_total += file_size
+
+    def file_done(self, file_size, downloaded):
+        with self.lock:
+            self.files_done += 1
+            if not downloaded:
+                # Skipped (or failed) files no longer count towards the bytes left to download.
+                self.files_skipped += 1
+                self.bytes_total -= file_size
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes_done += n
+
+    def snapshot(self):
+        """Current counts, with the download speed over the last rate_window seconds and the estimated time left."""
+        with self.lock:
+            now = time.monotonic()
+            self.samples.append((now, self.bytes_done))
+            while len(self.samples) > 2 and self.samples[1][0] < now - self.rate_window:
+                self.samples.popleft()
+
+            (then, bytes_then) = self.samples[0]
+            bytes_per_second = (self.bytes_done - bytes_then) / (now - then) if now > then else 0
+            bytes_left = max(0, self.bytes_total - self.bytes_done)
+
+            return {
+                "elapsed_seconds": round(now - self.started_at, 1),
+                "user": self.user,
+                "users_done": self.users_done,
+                "users_total": self.users_total,
+                "files_done": self.files_done,
+                "files_skipped": self.files_skipped,
+                "files_total": self.files_total,
+                "bytes_done": self.bytes_done,
+                "bytes_total": self.bytes_total,
+                "bytes_per_second": round(bytes_per_second),
+                "eta_seconds": round(bytes_left / bytes_per_second) if bytes_per_second else None,
+            }
+
+
+class progress_reporter:
+    """Shows a progress_tracker while the block runs.
+
+    On a terminal this is a single status line, without one is written to file as a JSON object per line
+    every json_interval seconds (for log pipelines, instead of redrawn progress bars). auto picks either
+    depending on whether file is a terminal.
+    """
+
+    def __init__(self, tracker, mode=PROGRESS_AUTO, json_interval=30, file=sys.stdout):
+        if mode == PROGRESS_AUTO:
+            mode = PROGRESS_TERMINAL if file.isatty() else PROGRESS_JSON
+
+        self.tracker = tracker
+        self.mode = mode
+        self.json_interval = json_interval
+        self.file = file
+        self.stopped = threading.Event()
+        self.bar = None
+        self.thread = None
+
+    def __enter__(self):
+        if self.mode == PROGRESS_TERMINAL:
+            self.bar = tqdm(
+                total=0, position=0, unit="B", unit_scale=True, unit_divisor=1024, dynamic_ncols=True,
+                bar_format="{desc}: {percentage:3.0f}%|{bar}| {n_fmt}{unit}/{total_fmt}{unit} [{elapsed}{postfix}]",
+            )
+        if self.mode in (PROGRESS_TERMINAL, PROGRESS_JSON):
+            self.thread = threading.Thread(target=self._report, daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, *_):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+        if self.mode == PROGRESS_TERMINAL:
+            self._render_terminal(self.tracker.snapshot())
+            self.bar.close()
+        elif self.mode == PROGRESS_JSON:
+            self._write_json("finished", self.tracker.snapshot())
+
+    def _report(self):
+        interval = 0.5 if self.mode == PROGRESS_TERMINAL else self.json_interval
+        while not self.stopped.wait(interval):
+            snapshot = self.tracker.snapshot()
+            if self.mode == PROGRESS_TERMINAL:
+                self._render_terminal(snapshot)
+            else:
+                self._write_json("progress", snapshot)
+
+    def _render_terminal(self, snapshot):
+        users = ""
+        if snapshot["users_total"]:
+            user_number = snapshot["users_done"] + (1 if snapshot["user"] else 0)
+            users = f"Users {user_number}/{snapshot['users_total']}, "
+
+        self.bar.desc = f"{users}Files {snapshot['files_done']}/{snapshot['files_total']}"
+        self.bar.total = snapshot["bytes_total"]
+        self.bar.n = min(snapshot["bytes_done"], snapshot["bytes_total"])
+
+        rate = tqdm.format_sizeof(snapshot["bytes_per_second"], "B/s", 1024)
+        eta = tqdm.format_interval(snapshot["eta_seconds"]) if snapshot["eta_seconds"] is not None else "?"
+        self.bar.set_postfix_str(f"{rate}, ETA {eta}", refresh=False)
+        self.bar.refresh()
+
+    def _write_json(self, event, snapshot):
+        record = {"event": event, "time": datetime.datetime.now().astimezone().isoformat(timespec="seconds")}
+        record.update(snapshot)
+        tqdm.write(json.dumps(record), file=self.file)
+        self.file.flush()
@@ -0,0 +1,152 @@
+import datetime
+import email.utils
+import re
+import threading
+import time
+import urllib.parse
+
+# Zoom groups its APIs in rate limit categories (https://developers.zoom.us/docs/api/rest/rate-limits/).
+# Endpoints default to these until the X-RateLimit-Category header of a response says otherwise.
+ENDPOINT_CATEGORIES = {
+    '/v2/users': 'medium',
+    '/v2/users/{id}/recordings': 'medium',
+    '/v2/meetings/{id}/recordings': 'light',
+}
+DEFAULT_CATEGORY = 'medium'
+
+# Requests per second per category for Pro accounts, Business and larger accounts have higher limits.
+DEFAULT_RATES = {'light': 30, 'medium': 20, 'heavy': 10}
+
+
+class token_bucket:
+    """Paces requests of one rate limit category.
+
+    The rate adapts to the server: it is halved whenever a request gets throttled (429) and grows back
+    slowly on successful requests, up to the configured rate, so requests settle just below the limit.
+    """
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take one request slot, returning the number of seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def throttled(self, retry_after):
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 32)
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def exhausted(self):
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class rate_limiter:
+    def __init__(self, rates: dict = DEFAULT_RATES, max_retries: int = 6, max_wait: float = 15 * 60):
+        self.buckets = {category.lower(): token_bucket(rate) for category, rate in rates.items()}
+        self.categories = dict(ENDPOINT_CATEGORIES)
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.throttled_seconds = 0
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def request(self, url, send):
+        """Send a request through the bucket of url's category, waiting out 429 responses.
+
+        :param send: function that sends the request and returns its response.
+        """
+        endpoint = get_endpoint(url)
+        for attempt in range(self.max_retries + 1):
+            self._wait(self._bucket(endpoint).reserve())
+            response = send()
+            self._observe(endpoint, response)
+
+            if response.status_code != 429 or attempt == self.max_retries:
+                if response.ok:
+                    self._bucket(endpoint).succeeded()
+                return response
+
+            retry_after = get_retry_after(response)
+            if retry_after is None:
+                retry_after = 2 ** attempt
+            elif retry_after > self.max_wait:
+                raise Exception(
+                    f'Rate limit of {endpoint} exceeded, retry after {round(retry_after)} seconds: '
+                    f'{response.headers.get("X-RateLimit-Type", "")} {response.text}'
+                )
+
+            with self.lock:
+                self.throttled_count += 1
+            self._bucket(endpoint).throttled(retry_after)
+
+    def _wait(self, seconds):
+        if seconds <= 0:
+            return
+
+        with self.lock:
+            self.throttled_seconds += seconds
+        time.sleep(seconds)
+
+    def _bucket(self, endpoint):
+        category = self.categories.get(endpoint, DEFAULT_CATEGORY)
+        return self.buckets.get(category) or self.buckets[DEFAULT_CATEGORY]
+
+    def _observe(self, endpoint, response):
+        category = response.headers.get('X-RateLimit-Category', '').split(' ')[0].lower()
+        if category in self.buckets:
+            self.categories[endpoint] = category
+
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            self._bucket(endpoint).exhausted()
+
+
+def get_endpoint(url):
+    """Path of url with user and meeting IDs replaced by {id}, e.g. /v2/meetings/{id}/recordings."""
+    segments = urllib.parse.urlparse(url).path.rstrip('/').split('/')
+    for i in range(1, len(segments)):
+        if segments[i - 1] in ('users', 'meetings'):
+            segments[i] = '{id}'
+
+    return '/'.join(segments)
+
+
+def get_retry_after(response):
+    """Seconds to wait according to the Retry-After header, which is either seconds or a date."""
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    if re.match(r'^\d+(\.\d+)?$', retry_after.strip()):
+        return float(retry_after)
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        try:
+            retry_at = datetime.datetime.fromisoformat(retry_after.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+
+    return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
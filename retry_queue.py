@@ -0,0 +1,41 @@
+import time
+
+
+class retry_queue:
+    """Meetings whose recordings could not be retrieved (e.g. still being processed), kept in the meetings
+    table of meetings.db and retried with exponential backoff until max_attempts is reached."""
+
+    def __init__(self, storage, base_delay=15 * 60, max_delay=24 * 60 * 60, max_attempts=10):
+        self.storage = storage
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def add_failure(self, meeting_uuid, user_email, error):
+        """Record a failed attempt, scheduling the next one base_delay * 2^(attempts - 1) seconds from now."""
+        with self.storage.lock:
+            rows = self.storage.query("SELECT attempts FROM meetings WHERE uuid = ?", (meeting_uuid,))
+            attempts = (rows[0][0] if rows else 0) + 1
+            next_attempt_at = time.time() + min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+            self.storage.write(
+                "INSERT INTO meetings (uuid, user_email, attempts, last_error, next_attempt_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (uuid) DO UPDATE SET user_email = COALESCE(excluded.user_email, user_email), "
+                "attempts = excluded.attempts, last_error = excluded.last_error, "
+                "next_attempt_at = excluded.next_attempt_at",
+                (meeting_uuid, user_email, attempts, str(error), next_attempt_at),
+            )
+
+    def remove(self, meeting_uuid):
+        self.storage.write("DELETE FROM meetings WHERE uuid = ?", (meeting_uuid,))
+
+    def get_due(self, limit):
+        """Return up to limit (uuid, user_email) of meetings due for another attempt, fewest attempts first."""
+        return self.storage.query(
+            "SELECT uuid, user_email FROM meetings WHERE next_attempt_at <= ? AND attempts < ? "
+            "ORDER BY attempts, next_attempt_at LIMIT ?",
+            (time.time(), self.max_attempts, limit),
+        )
+
+    def count_given_up(self):
+        return self.storage.query("SELECT COUNT(*) FROM meetings WHERE attempts >= ?", (self.max_attempts,))[0][0]
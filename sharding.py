@@ -0,0 +1,189 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import utils
+
+
+class user_leases:
+    """Splits the users of a backfill between worker processes or hosts that share database_path.
+
+    A worker leases a user before scanning it and holds the lease until every file of the user was handled,
+    renewing it every lease_seconds / 3 seconds. The lease of a worker that crashed or lost the database
+    expires after lease_seconds and the user is leased again by another worker, which resumes where the
+    files were left. Downloads of a user whose lease was lost are cancelled between chunks. Users are marked
+    done per job (e.g. a date range) once all of their files succeeded, so a restarted backfill skips them
+    and retries the others.
+
+    The database uses a rollback journal rather than WAL, which needs shared memory and so cannot be shared
+    between hosts.
+    """
+
+    def __init__(self, database_path, job, lease_seconds=300, worker_id=None):
+        self.conn = sqlite3.connect(database_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Leased users of this worker with their downloads not finished yet, and whether all were submitted.
+        self.pending = {}
+        self.submitted = set()
+        self.failed = set()
+        # Set once the lease of the user was taken by another worker, cancelling its downloads.
+        self.lost = {}
+        self.closed = threading.Event()
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_leases (
+                job TEXT, user_email TEXT, worker_id TEXT, expires_at REAL, done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job, user_email)
+            )
+        """)
+
+        threading.Thread(target=self._renew_periodically, daemon=True).start()
+
+    def iter_leased(self, users):
+        """Yield the (email, name) users that this worker leased, leasing the next one as the previous is taken."""
+        while True:
+            user = self._lease_next(users)
+            if user is None:
+                return
+            yield user
+
+    def wait_for_expired(self, users):
+        """Wait until a lease of another worker expires, returning True, or until every user is done or leased
+        by this worker, returning False."""
+        while True:
+            with self.lock:
+                leases = {
+                    user_email: (worker_id, expires_at, done)
+                    for user_email, worker_id, expires_at, done in self.conn.execute(
+                        "SELECT user_email, worker_id, expires_at, done FROM user_leases WHERE job = ?", (self.job,)
+                    )
+                }
+
+            now = time.time()
+            waiting = False
+            for user_email, _ in users:
+                worker_id, expires_at, done = leases.get(user_email, (None, 0, 0))
+                if done or worker_id == self.worker_id:
+                    continue
+                if expires_at <= now:
+                    return True
+                waiting = True
+
+            if not waiting:
+                return False
+            time.sleep(min(self.lease_seconds / 6, 60))
+
+    def track(self, user_email, download):
+        """Wrap a download(position, cancelled=...) of a leased user, which returns None when it failed, marking
+        the user done once all of its downloads succeeded (see all_submitted). Downloads are cancelled when
+        the lease of the user was lost to another worker."""
+        with self.lock:
+            self.pending[user_email] = self.pending.get(user_email, 0) + 1
+            lost = self.lost[user_email]
+
+        def tracked_download(position, cancelled=None):
+            downloaded = None if lost.is_set() else download(position, cancelled=utils.any_event(lost, cancelled))
+            # Not reached when the download raised, the user is then released by close.
+            self._finish(user_email, failed=downloaded is None)
+            return downloaded
+
+        return tracked_download
+
+    def all_submitted(self, user_email):
+        """Every download of user_email was tracked, the user is done once they finish."""
+        with self.lock:
+            self.submitted.add(user_email)
+        self._finish(user_email, 0)
+
+    def close(self):
+        """Stop renewing leases, releasing those of unfinished users to other workers right away."""
+        self.closed.set()
+        with self.lock:
+            self.conn.execute(
+                "UPDATE user_leases SET expires_at = 0 WHERE job = ? AND worker_id = ? AND done = 0",
+                (self.job, self.worker_id),
+            )
+            self.conn.close()
+
+    def _lease_next(self, users):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                unavailable = {
+                    user_email
+                    for (user_email,) in self.conn.execute(
+                        "SELECT user_email FROM user_leases WHERE job = ? AND (done = 1 OR expires_at > ?)",
+                        (self.job, time.time()),
+                    )
+                }
+                user = next((user for user in users if user[0] not in unavailable), None)
+                if user:
+                    self.conn.execute(
+                        "INSERT INTO user_leases (job, user_email, worker_id, expires_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (job, user_email) DO UPDATE SET "
+                        "worker_id = excluded.worker_id, expires_at = excluded.expires_at",
+                        (self.job, user[0], self.worker_id, time.time() + self.lease_seconds),
+                    )
+                    self.pending[user[0]] = 0
+                    self.lost[user[0]] = threading.Event()
+                    self.failed.discard(user[0])
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        return user
+
+    def _finish(self, user_email, count=1, failed=False):
+        with self.lock:
+            self.pending[user_email] -= count
+            if failed:
+                self.failed.add(user_email)
+            if self.pending[user_email] or user_email not in self.submitted:
+                return
+
+            del self.pending[user_email]
+            self.submitted.discard(user_email)
+            if self.lost[user_email].is_set():
+                return
+            if user_email in self.failed:
+                # Left to the next run (or to another worker once the lease expires) to retry.
+                utils.print_dim_red(f"Some files of user {user_email} failed, the user is not marked done.")
+            else:
+                self.conn.execute(
+                    "UPDATE user_leases SET done = 1 WHERE job = ? AND user_email = ? AND worker_id = ?",
+                    (self.job, user_email, self.worker_id),
+                )
+
+    def _renew_periodically(self):
+        while not self.closed.wait(self.lease_seconds / 3):
+            try:
+                self._renew()
+            except sqlite3.ProgrammingError:  # Closed meanwhile.
+                return
+            except sqlite3.Error as error:
+                # Tried again on the next renewal, the lease only expires after lease_seconds.
+                utils.print_dim_red(f"Failed to renew user leases: {error}")
+
+    def _renew(self):
+        with self.lock:
+            for user_email in list(self.pending):
+                if self.lost[user_email].is_set():
+                    continue
+
+                cursor = self.conn.execute(
+                    "UPDATE user_leases SET expires_at = ? WHERE job = ? AND user_email = ? AND worker_id = ?",
+                    (time.time() + self.lease_seconds, self.job, user_email, self.worker_id),
+                )
+                if not cursor.rowcount:
+                    self.lost[user_email].set()
+                    utils.print_dim_red(
+                        f"The lease of user {user_email} expired and was taken by another worker, "
+                        f"cancelling the rest of its files."
+                    )
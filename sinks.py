@@ -0,0 +1,341 @@
+import contextlib
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+# S3 rejects parts smaller than this, except for the last part of an upload.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+SINK_LOCAL = "local"
+SINK_S3 = "s3"
+
+
+class local_sink:
+    """Files under root_path on a local or mounted file system.
+
+    Downloads are written to a .tmp file next to their path and renamed into place once complete. A failed
+    download keeps its .tmp file, so it is resumed by the next attempt or run. Disk space for downloads is
+    reserved in disk_space (a disk_space_ledger) when given.
+    """
+
+    def __init__(self, root_path, disk_space=None):
+        self.root_path = root_path
+        self.disk_space = disk_space
+
+    def get_size(self, path):
+        """Size of the file at path, None if there is none."""
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def remove(self, path):
+        os.remove(path)
+
+    def link(self, source_path, path):
+        """Store path as a hard link to the file at source_path, returning False when it can't be linked."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(source_path, path)
+        except OSError:
+            return False
+
+        return True
+
+    def relink(self, source_path, path):
+        """Replace the file at path with a hard link to the file at source_path (with the same content)."""
+        link_path = path + ".link"
+        try:
+            os.link(source_path, link_path)
+            os.replace(link_path, path)
+        except OSError:
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            return False
+
+        return True
+
+    def hash(self, path):
+        return utils.hash_file(path).hexdigest()
+
+    def scan_file_sizes(self):
+        return scan_file_sizes(self.root_path)
+
+    @contextlib.contextmanager
+    def open(self, path, size):
+        """Reserve disk space for a download of size bytes to path, yielding the local_file to download it with."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = local_file(path)
+        with self.disk_space.reserve(file.tmp_path, size) if self.disk_space else contextlib.nullcontext():
+            yield file
+
+
+class local_file:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+
+    def download(self, url, expected_size, verbose_output, size_tolerance, **options):
+        """Download url to the .tmp file, returning its SHA-256 (see utils.download_with_progress for options)."""
+        return utils.download_with_progress(url, self.tmp_path, expected_size, verbose_output, size_tolerance, **options)
+
+    def commit(self):
+        """Move the downloaded file into place, returning its size."""
+        os.rename(self.tmp_path, self.path)
+        return os.path.getsize(self.path)
+
+
+class s3_sink:
+    """Objects in an S3 compatible bucket (AWS S3, MinIO, Ceph, ...), downloads are streamed straight into them.
+
+    A path under root_path is stored at the same relative key under prefix, so the folder layout (GROUP_BY_USER,
+    GROUP_BY_TOPIC, ...) carries over to keys. Needs boto3, which is only imported when this sink is used.
+    Objects can't be hard-linked, so duplicates are stored as copies made by the server.
+    """
+
+    def __init__(self, root_path, bucket, prefix="", part_size=16 * 1024 * 1024, endpoint_url=None,
+                 region_name=None, access_key_id=None, secret_access_key=None, max_connections=10):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImportError(
+                'The "s3" storage sink needs boto3, install it with: python -m pip install boto3'
+            ) from None
+
+        self.root_path = root_path
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.ClientError = ClientError
+        # Endpoints other than AWS (e.g. MinIO on localhost) usually don't resolve bucket subdomains.
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region_name,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            config=Config(
+                max_pool_connections=max_connections,
+                s3={"addressing_style": "path" if endpoint_url else "auto"},
+            ),
+        )
+
+    def get_key(self, path):
+        relative_path = os.path.relpath(path, self.root_path)
+        if relative_path.startswith(os.pardir):
+            raise ValueError(f"{path} is not in {self.root_path}.")
+
+        return self.prefix + relative_path.replace(os.sep, "/")
+
+    def get_path(self, key):
+        return os.path.join(self.root_path, *key[len(self.prefix):].split("/"))
+
+    def get_size(self, path):
+        """Size of the object of path, None if there is none."""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(path))["ContentLength"]
+        except self.ClientError as error:
+            if is_not_found(error):
+                return None
+            raise
+
+    def remove(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(path))
+
+    def link(self, source_path, path):
+        """Store path as a copy of the object of source_path made by the server, without downloading it again."""
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=self.get_key(path),
+                CopySource={"Bucket": self.bucket, "Key": self.get_key(source_path)},
+            )
+        except (self.ClientError, ValueError):
+            # Objects over 5 GB can't be copied in one request, and paths of other sinks have no object.
+            return False
+
+        return True
+
+    def relink(self, source_path, path):
+        return False
+
+    def hash(self, path):
+        """SHA-256 of the object of path, read back from the bucket. Raises FileNotFoundError if there is none."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.get_key(path))
+        except self.ClientError as error:
+            if is_not_found(error):
+                raise FileNotFoundError(path) from error
+            # Denied or throttled reads fail like those of an unreadable local file.
+            raise OSError(str(error)) from error
+
+        sha256 = hashlib.sha256()
+        with contextlib.closing(response["Body"]) as body:
+            for chunk in body.iter_chunks(utils.HASH_BUFFER_SIZE):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+    def scan_file_sizes(self):
+        """Yield (path, size) of every object under prefix."""
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                yield self.get_path(item["Key"]), item["Size"]
+
+    @contextlib.contextmanager
+    def open(self, path, size):
+        """Yield the s3_upload to download path with, which is aborted unless committed in the block."""
+        upload = s3_upload(self.client, self.bucket, self.get_key(path), self.part_size)
+        try:
+            yield upload
+        finally:
+            upload.abort()
+
+
+class s3_upload:
+    """A new object written to like a file, sent as the parts of a multipart upload.
+
+    Written bytes are buffered until they fill a part, which is sent in the background while the next part
+    fills, so a download holds at most two parts in memory whatever the size of the file. Nothing is visible
+    in the bucket until commit, objects smaller than a part are stored with a single request then.
+
+    Parts of an upload that was never completed nor aborted (e.g. of a killed run) are billed until they are
+    deleted, so unfinished uploads of the key are aborted before a new one is created. A lifecycle rule with
+    AbortIncompleteMultipartUpload also cleans up the uploads of keys that are never downloaded again.
+    """
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        self.in_flight = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.restart()
+
+    def download(self, url, expected_size, verbose_output, size_tolerance, segments=1, fsync=None, **options):
+        """Download url into the upload, returning its SHA-256 (see utils.stream_with_progress for options).
+
+        Parts are sent in order, so files are not downloaded in segments, and the bucket takes care of syncing.
+        """
+        return utils.stream_with_progress(url, self, expected_size, verbose_output, size_tolerance, **options)
+
+    def write(self, data):
+        self.buffer += data
+        self.sha256.update(data)
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._send_part()
+
+    def rollback(self):
+        """Discard the bytes written after the last part that was stored, returning the number of bytes kept."""
+        self._wait_for_part(ignore_errors=True)
+        self.buffer = bytearray()
+        self.sha256 = self.stored_sha256.copy()
+        self.size = self.stored_size
+        return self.size
+
+    def restart(self):
+        """Discard every byte written, parts that were stored are overwritten or left out of the object."""
+        self._wait_for_part(ignore_errors=True)
+        self.parts = []
+        self.stored_size = 0
+        self.stored_sha256 = hashlib.sha256()
+        self.rollback()
+
+    def commit(self):
+        """Store the object from the bytes written, returning its size."""
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer)
+        else:
+            if self.buffer or not self.parts:
+                self._send_part()
+            self._wait_for_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+            )
+            self.upload_id = None
+
+        self.executor.shutdown()
+        return self.size
+
+    def abort(self):
+        """Delete the parts stored so far, unless the upload was committed."""
+        self._wait_for_part(ignore_errors=True)
+        self.executor.shutdown()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def _send_part(self):
+        # The previous part is stored first, so only one part is sent at a time.
+        self._wait_for_part()
+        if self.upload_id is None:
+            self._abort_stale_uploads()
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+
+        part_number = len(self.parts) + 1
+        part, self.buffer = self.buffer, bytearray()
+        future = self.executor.submit(
+            self.client.upload_part,
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=part,
+        )
+        self.in_flight = (future, part_number, len(part), self.sha256.copy())
+
+    def _abort_stale_uploads(self):
+        try:
+            for page in self.client.get_paginator("list_multipart_uploads").paginate(
+                Bucket=self.bucket, Prefix=self.key
+            ):
+                for upload in page.get("Uploads", []):
+                    if upload["Key"] == self.key:
+                        self.client.abort_multipart_upload(
+                            Bucket=self.bucket, Key=self.key, UploadId=upload["UploadId"]
+                        )
+        except self.client.exceptions.ClientError:
+            # Without permission to list or abort uploads, they are left to a lifecycle rule.
+            pass
+
+    def _wait_for_part(self, ignore_errors=False):
+        if not self.in_flight:
+            return
+
+        future, part_number, size, sha256 = self.in_flight
+        self.in_flight = None
+        try:
+            etag = future.result()["ETag"]
+        except Exception:
+            if ignore_errors:
+                return
+            raise
+
+        self.parts.append({"PartNumber": part_number, "ETag": etag})
+        self.stored_size += size
+        self.stored_sha256 = sha256
+
+
+def is_not_found(error):
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return status == 404 or error.response.get("Error", {}).get("Code") in ("NoSuchKey", "NotFound")
+
+
+def scan_file_sizes(root_path):
+    """Yield (path, size) of every file under root_path."""
+    folders = [root_path]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat(follow_symlinks=False).st_size
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+
+
+def migrate_legacy_schema(conn):
+    """Version 1: the tables of meetings.db before it was versioned.
+
+    Databases of earlier versions of this script only have the meetings table, in an older layout, so this
+    migration adds its missing columns.
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS meetings (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS users
+            (email TEXT PRIMARY KEY, name TEXT, synced_from TEXT, synced_through TEXT);
+        CREATE TABLE IF NOT EXISTS cached_meetings
+            (uuid TEXT PRIMARY KEY, user_email TEXT, start_time TEXT, topic TEXT, data TEXT);
+        CREATE INDEX IF NOT EXISTS cached_meetings_user_start ON cached_meetings (user_email, start_time);
+        CREATE TABLE IF NOT EXISTS recording_files
+            (id TEXT PRIMARY KEY, meeting_uuid TEXT, file_type TEXT, file_size INTEGER,
+             recording_start TEXT, download_url TEXT);
+        CREATE TABLE IF NOT EXISTS downloaded_files
+            (id TEXT, path TEXT, size INTEGER, sha256 TEXT, completed_at TEXT, PRIMARY KEY (id, path));
+        CREATE INDEX IF NOT EXISTS downloaded_files_sha256 ON downloaded_files (sha256);
+    """)
+
+    # The meetings table originally only held UUIDs of meetings that were not ready.
+    columns = get_columns(conn, "meetings")
+    for column, definition in (
+        ("user_email", "TEXT"),
+        ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+        ("last_error", "TEXT"),
+        ("next_attempt_at", "REAL NOT NULL DEFAULT 0"),
+    ):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE meetings ADD COLUMN {column} {definition}")
+
+
+# Schema migrations, MIGRATIONS[i] upgrades a database from version i to version i + 1.
+# Append new migrations (SQL scripts or functions of the connection) to change the schema, never edit old ones.
+MIGRATIONS = [
+    migrate_legacy_schema,
+]
+
+
+def get_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+class storage:
+    """The single connection to meetings.db, shared by all threads.
+
+    Writes are batched: they run right away on the shared connection (so reads see them), but are only
+    committed every commit_interval seconds or commit_batch_size writes, instead of one fsync per write.
+    """
+
+    def __init__(self, database_path, commit_interval=2.0, commit_batch_size=500):
+        self.conn = sqlite3.connect(database_path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.commit_interval = commit_interval
+        self.commit_batch_size = commit_batch_size
+        self.pending_writes = 0
+        self.closed = threading.Event()
+
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -32000")
+        self.migrate()
+
+        threading.Thread(target=self._commit_periodically, daemon=True).start()
+
+    def migrate(self):
+        with self.lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, migration in enumerate(MIGRATIONS[version:], start=version):
+                if callable(migration):
+                    migration(self.conn)
+                else:
+                    self.conn.executescript(migration)
+                self.conn.execute(f"PRAGMA user_version = {i + 1}")
+                self.conn.commit()
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def write(self, sql, parameters=()):
+        with self.lock:
+            self.conn.execute(sql, parameters)
+            self._written(1)
+
+    def write_many(self, sql, parameters):
+        with self.lock:
+            cursor = self.conn.executemany(sql, parameters)
+            self._written(max(cursor.rowcount, 1))
+
+    def commit(self):
+        with self.lock:
+            if self.pending_writes:
+                self.conn.commit()
+                self.pending_writes = 0
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+    def _written(self, count):
+        self.pending_writes += count
+        if self.pending_writes >= self.commit_batch_size:
+            self.commit()
+
+    def _commit_periodically(self):
+        while not self.closed.wait(self.commit_interval):
+            try:
+                self.commit()
+            except sqlite3.ProgrammingError:  # Closed meanwhile.
+                return
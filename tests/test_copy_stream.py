@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+BODY = bytes(range(256)) * 4096
+
+
+class keep_alive_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.server.connection_count += 1
+        super().setup()
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        if self.path == "/chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for offset in range(0, len(BODY), 100000):
+                chunk = BODY[offset:offset + 100000]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+
+class copy_stream_test(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), keep_alive_handler)
+        self.server.daemon_threads = True
+        self.server.connection_count = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def download(self, path, chunk_size=64 * 1024, **kwargs):
+        with self.session.get(f"http://127.0.0.1:{self.server.server_address[1]}{path}", stream=True) as response:
+            output_file = io.BytesIO()
+            self.assertEqual(utils.copy_stream(response, output_file, chunk_size=chunk_size, **kwargs), len(BODY))
+            self.assertEqual(output_file.getvalue(), BODY)
+
+    def test_downloads_reuse_the_connection(self):
+        for _ in range(5):
+            self.download("/file")
+        self.assertEqual(self.server.connection_count, 1)
+
+    def test_chunked_downloads_reuse_the_connection(self):
+        for _ in range(5):
+            self.download("/chunked")
+        self.assertEqual(self.server.connection_count, 1)
+
+    def test_stall_watchdog_keeps_the_chunk_size(self):
+        for path in ("/file", "/chunked"):
+            chunks = []
+            self.download(path, len(BODY) // 2, on_chunk=lambda chunk: chunks.append(len(chunk)), min_speed=1000)
+            self.assertEqual(chunks, [len(BODY) // 2] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
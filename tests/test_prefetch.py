@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class prefetch_test(unittest.TestCase):
+    def test_later_user_is_scanned_while_earlier_user_is_consumed(self):
+        scanned = {user: threading.Event() for user in ("first", "second")}
+
+        def scan(user):
+            scanned[user].set()
+            yield from range(3)
+
+        scans = utils.lookahead(((user, utils.prefetch(scan(user))) for user in scanned), 1)
+        user, meetings = next(scans)
+
+        self.assertEqual(user, "first")
+        self.assertEqual(next(meetings), 0)
+        # Nothing asked for the meetings of the second user yet, its scan runs in the background.
+        self.assertTrue(scanned["second"].wait(5))
+        self.assertEqual(list(meetings), [1, 2])
+
+        user, meetings = next(scans)
+        self.assertEqual((user, list(meetings)), ("second", [0, 1, 2]))
+
+    def test_error_is_raised_after_earlier_items(self):
+        def scan():
+            yield 1
+            raise ValueError("listing failed")
+
+        items = utils.prefetch(scan())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+        with self.assertRaises(StopIteration):
+            next(items)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,24 @@
+import contextlib
+import ctypes
+import errno
+import hashlib
+import json
 import math
 import os
+import queue
 import re
-import shutil
+import socket
 import sys
 import unicodedata
 import urllib
+import urllib.error
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import reduce
 from json import dumps
-from time import sleep
-import socket
+from time import monotonic
+import requests
 from colorama import Fore, Style
 from tqdm import tqdm
 
@@ -89,28 +99,6 @@ def slugify(value, allow_unicode=True):
 	value = re.sub(r'[^\w\s-]', '', value.lower())
 	return re.sub(r'[-\s]+', '-', value).strip('-_')
 
-def wait_for_disk_space(file_size, path, minimum_free_disk, interval):
-	file_size_str = size_to_string(file_size)
-
-	free_disk = shutil.disk_usage(path)[2]
-	required_disk_space = file_size + minimum_free_disk
-	required_disk_space_str = size_to_string(required_disk_space)
-
-	i = 0
-	while free_disk < required_disk_space:
-		if i % 3 == 0:
-			free_disk_str = size_to_string(free_disk)
-			minimum_free_disk_str = size_to_string(minimum_free_disk)
-
-			print_bright_red(
-				f'Waiting for disk space... '
-				f'(File size: {file_size_str}, minimum free disk space: {minimum_free_disk_str}, '
-				f'available: {free_disk_str}/{required_disk_space_str})'
-			)
-		sleep(interval)
-		free_disk = shutil.disk_usage(path)[2]
-		i += 1
-
 def size_to_string(size_bytes, separator = ''):
 	if size_bytes == 0:
 		return '0' + str(separator) + 'B'
@@ -124,73 +112,717 @@ def print_bright_red(msg):
 	print_bright(Fore.RED + str(msg) + Fore.RESET)
 
 def print_bright(msg):
-	print(Style.BRIGHT + str(msg) + Style.RESET_ALL)
+	tqdm.write(Style.BRIGHT + str(msg) + Style.RESET_ALL)
 
 def print_dim_red(msg):
 	print_dim(Fore.RED + str(msg) + Fore.RESET)	
 
 def print_dim(msg):
-	print(Style.DIM + str(msg) + Style.RESET_ALL)
+	tqdm.write(Style.DIM + str(msg) + Style.RESET_ALL)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 0.2
+# Seconds between saves of the progress of a segmented download, see download_segmented_with_progress.
+SEGMENTS_STATE_INTERVAL = 5
+
+# Seconds to wait for a connection and between bytes of a response.
+DOWNLOAD_TIMEOUT = (10, 60)
 
-def download_with_progress(url, output_path, expected_size, verbose_output, size_tolerance):
-	class download_progress_bar(tqdm):
-		def __init__(self, expected_size=None, dynamic_ncols=True):
-			r_bar = '| {n_fmt}{unit}/{total_fmt}{unit} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
-			format = '{l_bar}{bar}' + r_bar
+# When downloaded files are flushed to disk with fsync: never (left to the OS), once when the file is complete
+# (before it is renamed into place), or after every chunk (so a crash loses no downloaded bytes, but slower).
+FSYNC_NEVER = 'never'
+FSYNC_FILE = 'file'
+FSYNC_CHUNK = 'chunk'
 
-			tqdm.__init__(
-				self, total=expected_size, unit='B', unit_divisor=1024, unit_scale=True, miniters=1,
-				dynamic_ncols=dynamic_ncols, bar_format=format
+class download_progress_bar(tqdm):
+	def __init__(self, expected_size=None, dynamic_ncols=True, position=None, disable=False):
+		r_bar = '| {n_fmt}{unit}/{total_fmt}{unit} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+		format = '{l_bar}{bar}' + r_bar
+
+		# Bars of concurrent downloads share the screen, so they only keep their line while in flight.
+		tqdm.__init__(
+			self, total=expected_size, unit='B', unit_divisor=1024, unit_scale=True, miniters=1,
+			dynamic_ncols=dynamic_ncols, bar_format=format, position=position, leave=position is None,
+			disable=disable
+		)
+
+	def update_to(self, b=1, bsize=1, tsize=None):
+		if tsize is not None:
+			self.total = tsize
+		self.update(b * bsize - self.n)
+
+class throttled_progress:
+	""" Passes updates on to a progress bar (and on_update) at most every interval seconds, rather than for every chunk. """
+	def __init__(self, bar, interval=PROGRESS_INTERVAL, on_update=None):
+		self.bar = bar
+		self.on_update = on_update
+		self.interval = interval
+		self.pending = 0
+		self.updated_at = monotonic()
+		self.lock = threading.Lock()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_):
+		self.flush()
+
+	def update(self, n):
+		with self.lock:
+			self.pending += n
+			if monotonic() - self.updated_at < self.interval:
+				return
+		self.flush()
+
+	def flush(self):
+		with self.lock:
+			n, self.pending, self.updated_at = self.pending, 0, monotonic()
+		if n:
+			self.bar.update(n)
+			if self.on_update:
+				self.on_update(n)
+
+class RangeNotSupportedError(Exception):
+	pass
+
+class DownloadStalledError(Exception):
+	pass
+
+class DownloadCancelledError(Exception):
+	pass
+
+class any_event:
+	""" Set when any of events (threading.Event or None) is set, e.g. for the cancelled of copy_stream. """
+	def __init__(self, *events):
+		self.events = [event for event in events if event is not None]
+
+	def is_set(self):
+		return any(event.is_set() for event in self.events)
+
+class throughput_watchdog:
+	""" Aborts a streamed response that stays below min_speed bytes per second for window seconds.
+
+	Read timeouts only catch connections that stop completely, a connection trickling a few bytes at a time
+	could keep a download going for days. The watchdog shuts down the socket of such a response from a
+	background thread, so the blocked read returns and copy_stream raises DownloadStalledError.
+
+	Time spent in paused blocks (waiting for the bandwidth limiter) is left out of the window, so a download
+	throttled below min_speed on purpose is not taken for a stalled one.
+	"""
+	def __init__(self, response, min_speed, window):
+		self.response = response
+		self.min_speed = min_speed
+		self.window = window
+		self.received = 0
+		self.stalled = False
+		self.done = threading.Event()
+		self.paused_seconds = 0
+		self.paused_at = None
+		self.lock = threading.Lock()
+
+		# Bytes are only counted once a read returns and reads block until their buffer is full, so a window
+		# must span several reads.
+		self.max_read_size = max(64 * 1024, int(min_speed * window / 4))
+
+	def __enter__(self):
+		threading.Thread(target=self._watch, daemon=True).start()
+		return self
+
+	def __exit__(self, *_):
+		self.done.set()
+
+	def update(self, n):
+		self.received += n
+
+	@contextlib.contextmanager
+	def paused(self):
+		with self.lock:
+			self.paused_at = monotonic()
+		try:
+			yield
+		finally:
+			with self.lock:
+				self.paused_seconds += monotonic() - self.paused_at
+				self.paused_at = None
+
+	def _active_time(self):
+		""" Seconds since an arbitrary point, not counting paused time. """
+		with self.lock:
+			now = monotonic()
+			return now - self.paused_seconds - (now - self.paused_at if self.paused_at is not None else 0)
+
+	def check(self):
+		if self.stalled:
+			raise DownloadStalledError(
+				f'Download slower than {size_to_string(self.min_speed)}/s for {self.window} seconds.'
 			)
 
-		def update_to(self, b=1, bsize=1, tsize=None):
-			if tsize is not None:
-				self.total = tsize
-			self.update(b * bsize - self.n)
-			
+	def _watch(self):
+		started_at = self._active_time()
+		samples = deque()
+		while not self.done.wait(1):
+			now = self._active_time()
+			samples.append((now, self.received))
+			while samples[0][0] < now - self.window:
+				samples.popleft()
+
+			if now - started_at >= self.window and self.received - samples[0][1] < self.min_speed * self.window:
+				self.stalled = True
+				self._abort()
+				return
+
+	def _abort(self):
+		sock = getattr(self.response.raw.connection, 'sock', None)
+		try:
+			if sock:
+				sock.shutdown(socket.SHUT_RDWR)
+			else:
+				self.response.close()
+		except OSError:
+			pass
 
-	with download_progress_bar(expected_size=expected_size) as t:
+def download_with_progress(
+	url, output_path, expected_size, verbose_output, size_tolerance, position=None, segments=1, session=requests,
+	bandwidth=None, chunk_size=DOWNLOAD_CHUNK_SIZE, fsync=FSYNC_FILE, timeout=DOWNLOAD_TIMEOUT, min_speed=None,
+	stall_window=120, on_progress=None, cancelled=None
+):
+	""" Download url to output_path, returning the SHA-256 hex digest of the downloaded file.
+
+	The digest is computed from the bytes as they are written. Only the bytes of a resumed partial file, and
+	files downloaded in segments (which arrive out of order), are read back from disk to hash them.
+	Every chunk read is accounted to bandwidth (a bandwidth_limiter) when given, see copy_stream for chunk_size
+	and fsync (one of the FSYNC_ policies). Each request has its own (connect, read) timeout, and responses
+	slower than min_speed bytes per second for stall_window seconds are aborted (see throughput_watchdog).
+	The progress bar of the file is only shown with verbose_output, on_progress is called with the number of
+	bytes downloaded since its last call (e.g. to update the progress of a whole run). Setting cancelled (a
+	threading.Event) stops the download between chunks with DownloadCancelledError, keeping the partial file.
+	"""
+	if segments > 1 or os.path.exists(segments_state_path(output_path)):
 		try:
-			download_speed = 1.1  # simulate slow download speed
-			time_out = expected_size / download_speed 		
-			socket.setdefaulttimeout(time_out)
-			urllib.request.urlretrieve(url, filename=output_path, reporthook=t.update_to)
-			file_size = os.path.getsize(output_path)
-			if abs(file_size - expected_size) > size_tolerance:
-				t.update_to(bsize=0, tsize=expected_size)
-				if verbose_output:
-					print_dim_red(
-						f'Size mismatch: Expected {expected_size} bytes but got {file_size}. '
-			   			f'Size difference: {size_to_string(abs(file_size - expected_size))}.\n'
-						f'You might want to increase FILE_SIZE_MISMATCH_TOLERANCE in config.py'
+			return download_segmented_with_progress(
+				url, output_path, expected_size, verbose_output, size_tolerance, position, segments, session,
+				bandwidth=bandwidth, chunk_size=chunk_size, fsync=fsync, timeout=timeout, min_speed=min_speed,
+				stall_window=stall_window, on_progress=on_progress, cancelled=cancelled
+			)
+		except RangeNotSupportedError:
+			if verbose_output:
+				print_dim('Server does not support byte ranges, downloading as a single stream.')
+			remove_download(output_path)
+
+	with download_progress_bar(expected_size=expected_size, position=position, disable=not verbose_output) as t:
+		# A partial file left by a failed attempt (or a killed run) is continued rather than restarted.
+		resume_from = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+		if resume_from >= expected_size:
+			sha256 = hash_file(output_path)
+		else:
+			response, resume_from = open_ranged(url, resume_from, session, timeout)
+			if resume_from and verbose_output:
+				print_dim(f'Resuming download at {size_to_string(resume_from)}.')
+
+			sha256 = hash_file(output_path, resume_from) if resume_from else hashlib.sha256()
+			with response, open(output_path, 'ab' if resume_from else 'wb') as output_file:
+				# The size of the file is kept, a partial file still ends where its downloaded bytes end.
+				preallocate(output_file, expected_size, keep_size=True)
+				t.update_to(bsize=resume_from)
+				content_length = int(response.headers.get('Content-Length', -1))
+
+				with throttled_progress(t, on_update=on_progress) as progress:
+					def on_chunk(chunk):
+						sha256.update(chunk)
+						progress.update(len(chunk))
+
+					received = copy_stream(
+						response, output_file, chunk_size=chunk_size, on_chunk=on_chunk, bandwidth=bandwidth, fsync=fsync,
+						min_speed=min_speed, stall_window=stall_window, cancelled=cancelled
 					)
-				raise Exception(f'Failed to download file at {url}.{"" if verbose_output else " Enable verbose output for more details."}')
-			
-			t.update_to(bsize=file_size, tsize=file_size)
-			t.close()
-
-			if file_size != expected_size and verbose_output:
-				print_dim_red(
-					f'Size mismatch within tolerance: Expected {expected_size} bytes but got {file_size}. '
-					f'Size difference: {size_to_string(abs(file_size - expected_size))}.'
+
+			if received < content_length:
+				raise urllib.error.ContentTooShortError(
+					f'Connection closed after {received} out of {content_length} bytes.', None
 				)
+
+		try:
+			check_download_size(url, os.path.getsize(output_path), expected_size, verbose_output, size_tolerance, t)
 		except:
+			# Only a complete file with the wrong size is corrupt, partial files are kept for resuming.
+			remove_download(output_path)
+			raise
+
+	return sha256.hexdigest()
+
+def download_segmented_with_progress(
+	url, output_path, expected_size, verbose_output, size_tolerance, position, segments, session=requests,
+	bandwidth=None, chunk_size=DOWNLOAD_CHUNK_SIZE, fsync=FSYNC_FILE, timeout=DOWNLOAD_TIMEOUT, min_speed=None,
+	stall_window=120, on_progress=None, cancelled=None
+):
+	""" Download url into output_path as concurrent byte ranges written in place into a preallocated file.
+
+	The progress of every segment is kept next to the file (see segments_state_path), so a retry, or a later
+	run, only fetches the bytes that are still missing from each segment. It is saved every
+	SEGMENTS_STATE_INTERVAL seconds while downloading, and only counts bytes already synced to disk, so even
+	a killed run loses at most the bytes of the last interval.
+	Raises RangeNotSupportedError when the server does not serve byte ranges.
+	"""
+	state_path = segments_state_path(output_path)
+	state = load_segments_state(state_path) if os.path.exists(output_path) else None
+
+	with download_progress_bar(expected_size=expected_size, position=position, disable=not verbose_output) as t:
+		if not state:
+			file_size = fetch_content_size(url, session, timeout)
 			try:
-				os.remove(output_path)
-			except OSError:
-				pass
-			
+				check_download_size(url, file_size, expected_size, verbose_output, size_tolerance, t)
+			except:
+				remove_download(output_path)
+				raise
+
+			# A partial single stream download is a valid prefix of the file, its bytes are not fetched again.
+			existing_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+			state = {'size': file_size, 'segments': plan_segments(file_size, segments, existing_size)}
+
+			with open(output_path, 'r+b' if existing_size else 'wb') as output_file:
+				output_file.truncate(file_size)
+				preallocate(output_file, file_size)
+			save_segments_state(state_path, state)
+		elif verbose_output:
+			print_dim(f'Resuming segmented download at {size_to_string(segments_done(state))}.')
+
+		t.update_to(bsize=segments_done(state), tsize=state['size'])
+		progress = throttled_progress(t, on_update=on_progress)
+		lock = threading.Lock()
+		# Set when a segment failed (or the download was interrupted), the other segments stop at their next chunk.
+		stopped = threading.Event()
+
+		def fetch_segment(segment):
+			offset, end = segment['start'] + segment['done'], segment['end']
+			response = open_stream(url, session, headers={'Range': f'bytes={offset}-{end}'}, timeout=timeout)
+			with response, open(output_path, 'r+b') as output_file:
+				if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+					raise RangeNotSupportedError()
+
+				unsynced = 0
+				synced_at = monotonic()
+
+				def checkpoint():
+					nonlocal unsynced, synced_at
+					# The bytes are synced before they count as done, a saved state never covers missing bytes.
+					sync_file(output_file)
+					with lock:
+						segment['done'] += unsynced
+						save_segments_state(state_path, state)
+					unsynced, synced_at = 0, monotonic()
+
+				def on_chunk(chunk):
+					nonlocal unsynced
+					unsynced += len(chunk)
+					progress.update(len(chunk))
+					if monotonic() - synced_at >= SEGMENTS_STATE_INTERVAL:
+						checkpoint()
+
+				output_file.seek(offset)
+				try:
+					offset += copy_stream(
+						response, output_file, end + 1 - offset, chunk_size, on_chunk, bandwidth, fsync, min_speed,
+						stall_window, any_event(stopped, cancelled)
+					)
+				finally:
+					checkpoint()
+
+			if offset <= end:
+				raise urllib.error.ContentTooShortError(
+					f'Connection closed {end + 1 - offset} bytes before the end of segment '
+					f'{segment["start"]}-{segment["end"]}.', None
+				)
+
+		pending = [segment for segment in state['segments'] if segment['start'] + segment['done'] <= segment['end']]
+		if pending:
+			with progress, ThreadPoolExecutor(max_workers=len(pending)) as executor:
+				futures = [executor.submit(fetch_segment, segment) for segment in pending]
+				try:
+					for future in futures:
+						future.result()
+				except BaseException:
+					# Leaving the block waits for the segments, which only save their state and return now.
+					stopped.set()
+					executor.shutdown(cancel_futures=True)
+					raise
+
+		os.remove(state_path)
+		check_download_size(url, state['size'], expected_size, verbose_output, size_tolerance, t)
+
+	return hash_file(output_path).hexdigest()
+
+def stream_with_progress(
+	url, upload, expected_size, verbose_output, size_tolerance, position=None, session=requests, bandwidth=None,
+	chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT, min_speed=None, stall_window=120, on_progress=None,
+	cancelled=None
+):
+	""" Download url straight into upload (e.g. an S3 multipart upload, see sinks.s3_upload) instead of a file,
+	returning the SHA-256 hex digest of the downloaded bytes.
+
+	upload keeps the parts it already stored when an attempt fails, a retry only fetches the bytes after them.
+	Nothing is stored for good here, the caller commits upload once the size was checked.
+	"""
+	with download_progress_bar(expected_size=expected_size, position=position, disable=not verbose_output) as t:
+		resume_from = upload.rollback()
+		response, offset = open_ranged(url, resume_from, session, timeout)
+		if offset < resume_from:
+			upload.restart()
+		elif offset and verbose_output:
+			print_dim(f'Resuming download at {size_to_string(offset)}.')
+
+		with response:
+			t.update_to(bsize=offset)
+			content_length = int(response.headers.get('Content-Length', -1))
+
+			with throttled_progress(t, on_update=on_progress) as progress:
+				received = copy_stream(
+					response, upload, chunk_size=chunk_size, on_chunk=lambda chunk: progress.update(len(chunk)),
+					bandwidth=bandwidth, min_speed=min_speed, stall_window=stall_window, cancelled=cancelled
+				)
+
+		if received < content_length:
+			raise urllib.error.ContentTooShortError(
+				f'Connection closed after {received} out of {content_length} bytes.', None
+			)
+
+		try:
+			check_download_size(url, upload.size, expected_size, verbose_output, size_tolerance, t)
+		except:
+			upload.restart()
+			raise
+
+	return upload.sha256.hexdigest()
+
+def copy_stream(
+	response, output_file, size=None, chunk_size=DOWNLOAD_CHUNK_SIZE, on_chunk=None, bandwidth=None, fsync=FSYNC_NEVER,
+	min_speed=None, stall_window=120, cancelled=None
+):
+	""" Copy the body of response, up to size bytes, to output_file, returning the number of bytes copied.
+
+	The body is read into a single buffer allocated up front and written from it in chunk_size writes, see
+	get_readinto for how it is read without copies. response must not have been read from yet. With min_speed,
+	the buffer is filled in reads small enough for the watchdog to see progress within stall_window.
+	on_chunk is called with a memoryview of every chunk once it is written, it is only valid during the call.
+	Raises DownloadStalledError when min_speed is given and the response is slower for stall_window seconds,
+	and DownloadCancelledError once cancelled (a threading.Event) is set.
+	"""
+	watchdog = throughput_watchdog(response, min_speed, stall_window) if min_speed else None
+	read_size = watchdog.max_read_size if watchdog else chunk_size
+
+	readinto = get_readinto(response)
+	view = memoryview(bytearray(chunk_size))
+	copied = 0
+	with watchdog or contextlib.nullcontext():
+		try:
+			while size is None or copied < size:
+				if cancelled is not None and cancelled.is_set():
+					raise DownloadCancelledError('Download cancelled.')
+
+				wanted = chunk_size if size is None else min(chunk_size, size - copied)
+				read = 0
+				while read < wanted:
+					count = readinto(view[read:min(wanted, read + read_size)])
+					if not count:
+						break
+					if watchdog:
+						watchdog.update(count)
+					read += count
+				if not read:
+					break
+
+				if bandwidth:
+					with watchdog.paused() if watchdog else contextlib.nullcontext():
+						bandwidth.consume(read)
+				output_file.write(view[:read])
+				if fsync == FSYNC_CHUNK:
+					sync_file(output_file)
+				if on_chunk:
+					on_chunk(view[:read])
+				copied += read
+		except Exception:
+			# Reads fail in various ways on a socket shut down by the watchdog.
+			if watchdog:
+				watchdog.check()
 			raise
 
+	if watchdog:
+		watchdog.check()
+	release_read_connection(response)
+	if fsync == FSYNC_FILE:
+		sync_file(output_file)
+
+	return copied
+
+def get_readinto(response):
+	""" The readinto of the body of a streamed requests response that reads straight into the given buffer.
+
+	urllib3 2.x implements HTTPResponse.readinto with read(), which allocates a new bytes object for every
+	chunk and copies it into the buffer. The http.client response it wraps reads into the buffer itself, so it
+	is used directly when urllib3 has nothing to do in between: no Content-Encoding to decode and nothing read
+	(and possibly buffered by urllib3) yet. It still decodes the chunked transfer encoding and stops at the end
+	of the body, but urllib3 doesn't see that end, see release_read_connection. Falls back to the readinto of
+	urllib3 otherwise.
+	"""
+	raw = response.raw
+	fp = getattr(raw, '_fp', None)
+	encoding = response.headers.get('Content-Encoding', 'identity').lower()
+	if fp is None or not hasattr(fp, 'readinto') or encoding != 'identity' or raw.tell():
+		return raw.readinto
+	return fp.readinto
+
+def release_read_connection(response):
+	""" Return the connection of response to its pool once its body was read to the end.
+
+	urllib3 only does this itself when it read the end of the body, closing a response it didn't see end
+	closes its connection, so every download read through get_readinto would need a new connection.
+	"""
+	fp = getattr(response.raw, '_fp', None)
+	if fp is not None and hasattr(fp, 'isclosed') and fp.isclosed():
+		response.raw.release_conn()
+
+def sync_file(file):
+	file.flush()
+	os.fsync(file.fileno())
+
+FALLOC_FL_KEEP_SIZE = 1
+
+def preallocate(file, size, keep_size=False):
+	""" Allocate the disk blocks of the first size bytes of file up front, to limit fragmentation.
+
+	With keep_size the file keeps its size (Linux only), otherwise it grows to size like with truncate.
+	Raises OSError when the disk is full, returns False when the platform or file system can't preallocate.
+	"""
+	try:
+		if keep_size:
+			libc = ctypes.CDLL(None, use_errno=True) if sys.platform.startswith('linux') else None
+			if libc is None or not hasattr(libc, 'fallocate64'):
+				return False
+			if libc.fallocate64(
+				file.fileno(), FALLOC_FL_KEEP_SIZE, ctypes.c_int64(0), ctypes.c_int64(size)
+			) != 0:
+				raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+		elif hasattr(os, 'posix_fallocate'):
+			os.posix_fallocate(file.fileno(), 0, size)
+		else:
+			return False
+	except OSError as error:
+		if error.errno in (errno.ENOSPC, errno.EDQUOT):
+			raise
+		return False
+
+	return True
+
+def hash_file(path, size=None, sha256=None):
+	""" Hash the first size bytes (all when None) of the file at path with SHA-256.
+
+	The file is read in large chunks into a single reused buffer, hashlib releases the GIL while hashing
+	them so several files can be hashed in parallel on threads.
+	:return: the hash object, which can be further updated.
+	"""
+	sha256 = sha256 or hashlib.sha256()
+	buffer = bytearray(HASH_BUFFER_SIZE)
+	view = memoryview(buffer)
+	remaining = size if size is not None else math.inf
+
+	with open(path, 'rb', buffering=0) as file:
+		while remaining > 0:
+			read = file.readinto(view[:min(HASH_BUFFER_SIZE, remaining)])
+			if not read:
+				break
+			sha256.update(view[:read])
+			remaining -= read
+
+	return sha256
+
+def plan_segments(file_size, segments, existing_size=0):
+	segment_size = math.ceil(file_size / segments)
+	return [
+		{'start': start, 'end': min(start + segment_size, file_size) - 1, 'done': min(max(existing_size - start, 0), segment_size)}
+		for start in range(0, file_size, segment_size)
+	]
+
+def segments_done(state):
+	return sum(segment['done'] for segment in state['segments'])
+
+def segments_state_path(output_path):
+	return output_path + '.segments'
+
+def load_segments_state(state_path):
+	try:
+		with open(state_path) as state_file:
+			return json.load(state_file)
+	except (OSError, ValueError):
+		return None
+
+def save_segments_state(state_path, state):
+	# Replaced in one step, a run killed while saving keeps the previous state rather than a truncated one.
+	tmp_path = state_path + '.tmp'
+	with open(tmp_path, 'w') as state_file:
+		json.dump(state, state_file)
+	os.replace(tmp_path, state_path)
+
+def fetch_content_size(url, session=requests, timeout=DOWNLOAD_TIMEOUT):
+	""" Find the size of the file at url with a single byte range request.
+
+	Raises RangeNotSupportedError when the server does not answer with a Content-Range header.
+	"""
+	with open_stream(url, session, headers={'Range': 'bytes=0-0'}, timeout=timeout) as response:
+		content_range = response.headers.get('Content-Range', '')
+		if response.status_code != 206 or not re.match(r'^bytes 0-0/\d+$', content_range):
+			raise RangeNotSupportedError()
+
+		return int(content_range.split('/')[1])
+
+def check_download_size(url, file_size, expected_size, verbose_output, size_tolerance, t):
+	if abs(file_size - expected_size) > size_tolerance:
+		t.update_to(bsize=0, tsize=expected_size)
+		if verbose_output:
+			print_dim_red(
+				f'Size mismatch: Expected {expected_size} bytes but got {file_size}. '
+	   			f'Size difference: {size_to_string(abs(file_size - expected_size))}.\n'
+				f'You might want to increase FILE_SIZE_MISMATCH_TOLERANCE in config.py'
+			)
+		raise Exception(f'Failed to download file at {url}.{"" if verbose_output else " Enable verbose output for more details."}')
+	
+	t.update_to(bsize=file_size, tsize=file_size)
+	t.close()
+
+	if file_size != expected_size and verbose_output:
+		print_dim_red(
+			f'Size mismatch within tolerance: Expected {expected_size} bytes but got {file_size}. '
+			f'Size difference: {size_to_string(abs(file_size - expected_size))}.'
+		)
+
+def remove_download(output_path):
+	for path in (output_path, segments_state_path(output_path)):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+def open_stream(url, session=requests, headers=None, timeout=DOWNLOAD_TIMEOUT):
+	response = session.get(url, headers=headers, stream=True, timeout=timeout)
+	response.raise_for_status()
+	return response
+
+def open_ranged(url, resume_from, session=requests, timeout=DOWNLOAD_TIMEOUT):
+	""" Open url for reading from byte resume_from onwards.
+
+	:return: tuple of the response and the offset it actually starts at, which is 0 when the
+	server ignores the Range header or cannot satisfy it.
+	"""
+	if not resume_from:
+		return open_stream(url, session, timeout=timeout), 0
+
+	response = session.get(url, headers={'Range': f'bytes={resume_from}-'}, stream=True, timeout=timeout)
+	if response.status_code == 416:  # Range Not Satisfiable
+		response.close()
+		return open_stream(url, session, timeout=timeout), 0
+
+	response.raise_for_status()
+	if response.status_code != 206:  # Partial Content
+		return response, 0
+
+	if not response.headers.get('Content-Range', '').startswith(f'bytes {resume_from}-'):
+		response.close()
+		return open_stream(url, session, timeout=timeout), 0
+
+	return response, resume_from
+
+def concurrent_map(function, iterable, max_workers, ordered=True):
+	""" Like map(), but calls function on up to max_workers threads.
+
+	At most 2 * max_workers calls are queued ahead of the consumer, so iterable is consumed lazily.
+	With ordered=False results are yielded as soon as they are ready instead of in input order.
+	Exceptions raised by function are raised when their result is reached.
+	"""
+	if max_workers <= 1:
+		yield from map(function, iterable)
+		return
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = deque()
+		iterator = iter(iterable)
+		exhausted = False
+
+		while pending or not exhausted:
+			while not exhausted and len(pending) < 2 * max_workers:
+				try:
+					pending.append(executor.submit(function, next(iterator)))
+				except StopIteration:
+					exhausted = True
+
+			if not pending:
+				break
+
+			if ordered:
+				yield pending.popleft().result()
+			else:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					pending.remove(future)
+					yield future.result()
+
+class prefetch:
+	""" Consume iterable on a background thread, yielding its items through a queue of at most max_size items.
+
+	The thread starts right away rather than on the first next(), so the items are fetched ahead before they are
+	asked for. Exceptions raised by iterable are raised to the consumer once the items before them were yielded.
+	"""
+	_done = object()
+
+	def __init__(self, iterable, max_size=100):
+		self.iterable = iterable
+		self.items = queue.Queue(maxsize=max_size)
+		self.finished = False
+		threading.Thread(target=self._produce, daemon=True).start()
+
+	def __iter__(self): return self
+
+	def __next__(self):
+		if self.finished:
+			raise StopIteration
+
+		item, error = self.items.get()
+		if item is self._done:
+			self.finished = True
+			if error:
+				raise error
+			raise StopIteration
+		return item
+
+	def _produce(self):
+		try:
+			for item in self.iterable:
+				self.items.put((item, None))
+			self.items.put((self._done, None))
+		except BaseException as error:
+			self.items.put((self._done, error))
+
+def lookahead(iterable, size):
+	""" Yield the items of iterable while keeping up to size more items already taken from it. """
+	buffer = deque()
+	for item in iterable:
+		buffer.append(item)
+		if len(buffer) > size:
+			yield buffer.popleft()
+
+	yield from buffer
+
+def length_hint(iterable):
+	return len(iterable) if hasattr(iterable, '__len__') else None
+
 def is_debug() -> bool:
     """Return if the debugger is currently active"""
     return hasattr(sys, 'gettrace') and sys.gettrace() is not None
 
 class percentage_tqdm(tqdm):
-	def __init__(self, iterable=None, total=None, dynamic_ncols=True):
+	def __init__(self, iterable=None, total=None, dynamic_ncols=True, disable=False):
+		# Also disabled when not writing to a terminal (disable=None), where redrawn bars are only noise.
 		tqdm.__init__(
 			self, iterable=iterable, total=total, bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]',
-			dynamic_ncols=dynamic_ncols
+			dynamic_ncols=dynamic_ncols, disable=disable or None
 		)
 
 class chain:
@@ -1,16 +1,28 @@
+import collections
 import datetime
-import math
+import functools
 import os
 import traceback
 from calendar import monthrange
 from types import ModuleType
-import sqlite3
 import time
 
 import colorama
 from colorama import Fore, Style
 
 import utils
+from bandwidth_limiter import bandwidth_limiter
+from disk_space import disk_space_ledger
+from download_manifest import download_manifest
+from download_pool import download_pool
+from metadata_cache import metadata_cache
+from metrics import run_metrics
+from profiling import run_profiler, trace_recorder
+from progress import progress_reporter, progress_tracker
+from retry_queue import retry_queue
+from sharding import user_leases
+from sinks import SINK_S3, local_sink, s3_sink
+from storage import storage
 from zoom_client import zoom_client
 import ssl
 
@@ -25,36 +37,84 @@ except ImportError:
         "Missing config file, copy config_template.py to config.py and change as needed."
     )
 
-client = zoom_client(
-    account_id=CONFIG.ACCOUNT_ID,
-    client_id=CONFIG.CLIENT_ID,
-    client_secret=CONFIG.CLIENT_SECRET,
-)
-
-# Connect to the SQLite database (or create it if it doesn't exist)
-conn = sqlite3.connect("meetings.db")
-
-# Create a cursor object to execute SQL queries
-cursor = conn.cursor()
-
-# Create a table to store the meeting UUIDs if it doesn't exist already
-cursor.execute("""CREATE TABLE IF NOT EXISTS meetings
-                (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE)""")
-
-# Commit the transaction
-conn.commit()
+metrics = run_metrics()
+progress = progress_tracker()
+# Created from the config by setup(), so that variables missing from config.py are reported like in main().
+client = database = not_ready_meetings = cache = manifest = None
+disk_space = bandwidth = sink = tracer = None
+
+
+def setup():
+    global client, database, not_ready_meetings, cache, manifest, disk_space, bandwidth, sink, tracer
+
+    client = zoom_client(
+        account_id=CONFIG.ACCOUNT_ID,
+        client_id=CONFIG.CLIENT_ID,
+        client_secret=CONFIG.CLIENT_SECRET,
+        pool_size=CONFIG.HTTP_POOL_SIZE,
+        connect_timeout=CONFIG.HTTP_CONNECT_TIMEOUT,
+        read_timeout=CONFIG.HTTP_READ_TIMEOUT,
+        rate_limits=CONFIG.API_RATE_LIMITS,
+        metrics=metrics,
+    )
 
+    # meetings.db (created if it doesn't exist) keeps meetings that could not be retrieved for later retries,
+    # scanned metadata and the manifest of downloaded files, all through one shared connection.
+    database = storage("meetings.db")
+    not_ready_meetings = retry_queue(
+        database,
+        base_delay=CONFIG.NOT_READY_RETRY_DELAY,
+        max_attempts=CONFIG.NOT_READY_MAX_ATTEMPTS,
+    )
+    cache = metadata_cache(database)
+    manifest = download_manifest(database)
+    disk_space = disk_space_ledger(CONFIG.MINIMUM_FREE_DISK)
+    bandwidth = bandwidth_limiter(
+        CONFIG.DOWNLOAD_SPEED_LIMIT, CONFIG.DOWNLOAD_SPEED_SCHEDULE
+    )
+    if CONFIG.STORAGE_SINK == SINK_S3:
+        sink = s3_sink(
+            utils.prepend_path_on_windows(CONFIG.OUTPUT_PATH),
+            CONFIG.S3_BUCKET,
+            CONFIG.S3_PREFIX,
+            CONFIG.S3_PART_SIZE,
+            endpoint_url=CONFIG.S3_ENDPOINT_URL,
+            region_name=CONFIG.S3_REGION,
+            access_key_id=CONFIG.S3_ACCESS_KEY_ID,
+            secret_access_key=CONFIG.S3_SECRET_ACCESS_KEY,
+            max_connections=CONFIG.HTTP_POOL_SIZE,
+        )
+    else:
+        sink = local_sink(
+            utils.prepend_path_on_windows(CONFIG.OUTPUT_PATH), disk_space
+        )
+    # Created last, the run report is only written once everything it reports on exists.
+    tracer = trace_recorder(enabled=CONFIG.TRACE_PATH is not None)
 
 def main():
     NOT_READY_FILES_ONLY = CONFIG.NOT_READY_FILES_ONLY
 
+    CONFIG.OUTPUT_PATH = utils.prepend_path_on_windows(CONFIG.OUTPUT_PATH)
+
     if NOT_READY_FILES_ONLY:
-        download_not_ready_files()
-    else:
-        CONFIG.OUTPUT_PATH = utils.prepend_path_on_windows(CONFIG.OUTPUT_PATH)
+        print_filter_warnings()
 
+        file_count, total_size, skipped_count = download_not_ready_files()
+        print_summary(file_count, total_size, skipped_count)
+
+        given_up_count = not_ready_meetings.count_given_up()
+        if given_up_count:
+            utils.print_dim_red(
+                f"Gave up on {given_up_count} meetings after {CONFIG.NOT_READY_MAX_ATTEMPTS} attempts."
+            )
+    elif CONFIG.VERIFY_FILES_ONLY:
+        verify_downloaded_files()
+    else:
         print_filter_warnings()
 
+        if CONFIG.RECONCILE_MANIFEST:
+            reconcile_manifest()
+
         from_date = datetime.datetime(
             CONFIG.START_YEAR, CONFIG.START_MONTH, CONFIG.START_DAY or 1
         )
@@ -64,19 +124,118 @@ def main():
             CONFIG.END_DAY or monthrange(CONFIG.END_YEAR, CONFIG.END_MONTH)[1],
         )
 
-        file_count, total_size, skipped_count = download_recordings(
-            get_users(), from_date, to_date
-        )
+        leases = None
+        if CONFIG.SHARD_DATABASE_PATH:
+            leases = user_leases(
+                CONFIG.SHARD_DATABASE_PATH,
+                f"{date_to_str(from_date)}..{date_to_str(to_date)}",
+                CONFIG.SHARD_LEASE_SECONDS,
+            )
+            utils.print_dim(
+                f"Sharing users with other workers through {CONFIG.SHARD_DATABASE_PATH} "
+                f"as worker {leases.worker_id}."
+            )
+
+        try:
+            file_count, total_size, skipped_count = download_recordings(
+                get_users(), from_date, to_date, leases
+            )
+        finally:
+            if leases:
+                leases.close()
+        print_summary(file_count, total_size, skipped_count)
+
+    metrics.outcome = "completed"
+
 
-        total_size_str = utils.size_to_string(total_size)
+def print_summary(file_count, total_size, skipped_count):
+    total_size_str = utils.size_to_string(total_size)
 
-        print(
-            f"{Style.BRIGHT}Downloaded {Fore.GREEN}{file_count}{Fore.RESET} files.",
-            f"Total size: {Fore.GREEN}{total_size_str}{Fore.RESET}.{Style.RESET_ALL}",
-            f"Skipped: {skipped_count} files.",
+    print(
+        f"{Style.BRIGHT}Downloaded {Fore.GREEN}{file_count}{Fore.RESET} files.",
+        f"Total size: {Fore.GREEN}{total_size_str}{Fore.RESET}.{Style.RESET_ALL}",
+        f"Skipped: {skipped_count} files.",
+    )
+
+    if client.rate_limiter.throttled_seconds:
+        utils.print_dim(
+            f"Waited {round(client.rate_limiter.throttled_seconds)} seconds for API rate limits "
+            f"({client.rate_limiter.throttled_count} throttled requests)."
         )
 
 
+def write_run_report():
+    report = metrics.report(
+        progress=progress.snapshot(),
+        waits={
+            "api_rate_limit_seconds": round(client.rate_limiter.throttled_seconds, 3),
+            "api_throttled_requests": client.rate_limiter.throttled_count,
+            "disk_space_seconds": round(disk_space.waited_seconds, 3),
+            "bandwidth_limit_seconds": round(bandwidth.throttled_seconds, 3),
+        },
+    )
+
+    if CONFIG.RUN_REPORT_PATH:
+        metrics.write_json(CONFIG.RUN_REPORT_PATH, report)
+    if CONFIG.PROMETHEUS_TEXTFILE_PATH:
+        metrics.write_prometheus(CONFIG.PROMETHEUS_TEXTFILE_PATH, report)
+    if CONFIG.TRACE_PATH:
+        tracer.write(CONFIG.TRACE_PATH)
+
+
+def verify_downloaded_files():
+    utils.print_bright("Verifying downloaded files:")
+
+    def verify(downloaded_file):
+        path, _, sha256 = downloaded_file
+        try:
+            return path, sink.hash(path) == sha256, None
+        except FileNotFoundError:
+            return path, None, None
+        except OSError as error:
+            # Files that can't be read (denied, throttled, ...) are neither missing nor known to differ.
+            return path, None, error
+
+    downloaded_files = manifest.get_hashed_files()
+    results = utils.concurrent_map(verify, downloaded_files, os.cpu_count() or 1, False)
+    mismatched_paths, missing_paths, unreadable_paths = [], [], []
+    with metrics.phase("verify_files"):
+        for path, matches, error in utils.percentage_tqdm(
+            results, total=len(downloaded_files)
+        ):
+            if error:
+                unreadable_paths.append((path, error))
+            elif matches is None:
+                missing_paths.append(path)
+            elif not matches:
+                mismatched_paths.append(path)
+
+    for path in missing_paths:
+        utils.print_dim_red(f"Missing: {path}")
+    for path, error in unreadable_paths:
+        utils.print_dim_red(f"Unreadable: {path} ({error})")
+    for path in mismatched_paths:
+        utils.print_bright_red(f"Content mismatch: {path}")
+
+    print(
+        f"{Style.BRIGHT}Verified {Fore.GREEN}{len(downloaded_files)}{Fore.RESET} files.{Style.RESET_ALL}",
+        f"Mismatched: {len(mismatched_paths)} files.",
+        f"Missing: {len(missing_paths)} files.",
+        f"Unreadable: {len(unreadable_paths)} files.",
+    )
+
+
+def reconcile_manifest():
+    utils.print_bright(f"Reconciling downloaded files with {CONFIG.OUTPUT_PATH}:")
+    with metrics.phase("reconcile_manifest"):
+        checked_count, removed_count = manifest.reconcile(sink.scan_file_sizes())
+    utils.print_dim(
+        f"Checked {checked_count} downloaded files, {removed_count} were moved, deleted or changed "
+        f"and will be checked again."
+    )
+    print()
+
+
 def print_filter_warnings():
     did_print = False
 
@@ -108,12 +267,13 @@ def get_users():
     pages = utils.chain(
         client.paginate(active_users_url), client.paginate(inactive_users_url)
     )
-    for page in utils.percentage_tqdm(pages):
-        (
-            users.extend(
-                [(user["email"], get_user_name(user)) for user in page["users"]]
-            ),
-        )
+    with metrics.phase("list_users"):
+        for page in utils.percentage_tqdm(pages):
+            (
+                users.extend(
+                    [(user["email"], get_user_name(user)) for user in page["users"]]
+                ),
+            )
 
     print()
     return users
@@ -129,47 +289,159 @@ def get_user_name(user_data):
         return first_name or last_name
 
 
-def download_recordings(users, from_date, to_date):
-    file_count, total_size, skipped_count = 0, 0, 0
+def download_recordings(users, from_date, to_date, leases=None):
+    """Download the recordings of users, or with leases (see user_leases) only of the users
+    this worker leased."""
 
-    for user_email, user_name in users:
-        user_description = get_user_description(user_email, user_name)
-        user_host_folder = get_user_host_folder(user_email)
+    def scan_user(user):
+        user_email, user_name = user
 
-        utils.print_bright(
-            f"Downloading recordings from user {user_description} - Starting at {date_to_str(from_date)} "
-            f"and up to {date_to_str(to_date)} (inclusive)."
-        )
+        scan_from, cached_meetings, synced_range = from_date, [], None
+        if CONFIG.INCREMENTAL_SYNC:
+            synced_range = get_incremental_synced_range(user_email, from_date)
+            if synced_range:
+                # Dates before the look-back window were already fully scanned, their meetings come from the cache.
+                lookback_from = synced_range[1] - datetime.timedelta(
+                    days=CONFIG.INCREMENTAL_SYNC_LOOKBACK_DAYS
+                )
+                # Capped at the end of the range, a cache synced past it must not yield later meetings.
+                end_of_range = to_date + datetime.timedelta(days=1)
+                scan_from = min(max(from_date, lookback_from), end_of_range)
+                cached_meetings = cache.get_meetings(
+                    user_email, from_date, min(scan_from, end_of_range)
+                )
 
-        meetings = get_meetings(get_meeting_uuids(user_email, from_date, to_date))
-        user_file_count, user_total_size, user_skipped_count = (
-            download_recordings_from_meetings(meetings, user_host_folder)
+        # Pipeline stages: listed meetings -> meeting recordings -> file downloads (in the pool).
+        # Each stage pulls lazily from the previous one through bounded queues, so downloads start with
+        # the first recording found and scanning waits when downloads fall behind.
+        listed_meetings = iter_listed_meetings(
+            user_email, scan_from, to_date, show_progress=False
         )
+        if not CONFIG.SINGLE_PASS_SCAN:
+            listed_meetings = (meeting["uuid"] for meeting in listed_meetings)
 
-        utils.print_bright(
-            "######################################################################"
-        )
-        print()
+        def sync_meetings():
+            yield from cached_meetings
 
-        file_count += user_file_count
-        total_size += user_total_size
-        skipped_count += user_skipped_count
+            meetings = iter_meetings(
+                listed_meetings,
+                show_progress=False,
+                user_email=user_email,
+            )
+            for meeting in meetings:
+                cache.save_meeting(user_email, meeting)
+                yield meeting
+
+            # Only reached once every date window was listed.
+            synced_through = min(to_date, datetime.datetime.now())
+            if synced_range:
+                cache.set_synced_range(
+                    user_email,
+                    user_name,
+                    min(synced_range[0], from_date),
+                    max(synced_range[1], synced_through),
+                )
+            else:
+                cache.set_synced_range(user_email, user_name, from_date, synced_through)
+
+        return utils.prefetch(sync_meetings())
+
+    with report_progress(), download_pool(
+        CONFIG.MAX_CONCURRENT_DOWNLOADS,
+        CONFIG.MAX_CONCURRENT_DOWNLOADS_PER_USER,
+        progress=progress,
+    ) as pool:
+        while True:
+            # The next users are scanned ahead in the background, their recordings are still handed to
+            # the download pool in the original order of the users.
+            users_to_scan = leases.iter_leased(users) if leases else users
+            scans = utils.lookahead(
+                ((user, scan_user(user)) for user in users_to_scan),
+                CONFIG.MAX_CONCURRENT_USER_SCANS - 1,
+            )
+            for (user_email, user_name), meetings in scans:
+                print_user_header(user_email, user_name, from_date, to_date)
+                progress.start_user(user_email, utils.length_hint(users))
+
+                with tracer.span("user", "user", user=user_email):
+                    download_recordings_from_meetings(
+                        meetings,
+                        get_user_host_folder(user_email),
+                        pool,
+                        user_email,
+                        leases,
+                    )
+                if leases:
+                    leases.all_submitted(user_email)
+                progress.user_done()
 
-    return (file_count, total_size, skipped_count)
+                utils.print_bright(
+                    "######################################################################"
+                )
+                print()
 
+            # Users of workers that stop renewing their leases are taken over once the leases expire.
+            if not leases or not leases.wait_for_expired(users):
+                break
+
+    return (pool.file_count, pool.total_size, pool.skipped_count)
 
-def download_not_ready_files():
-    conn = sqlite3.connect("meetings.db")
 
-    cursor = conn.cursor()
+def report_progress():
+    """Show the progress of the run (see progress_reporter) while the block runs."""
+    return progress_reporter(
+        progress, CONFIG.PROGRESS_OUTPUT, CONFIG.PROGRESS_JSON_INTERVAL
+    )
+
+
+def get_incremental_synced_range(user_email, from_date):
+    """The cached synced range of the user when it can be continued from from_date, None otherwise."""
+    synced_range = cache.get_synced_range(user_email)
+    if synced_range and synced_range[0] <= from_date <= synced_range[1]:
+        return synced_range
+
+    return None
 
-    cursor.execute("SELECT uuid FROM meetings")
 
-    rows = cursor.fetchall()
+def print_user_header(user_email, user_name, from_date, to_date):
+    utils.print_bright(
+        f"Downloading recordings from user {get_user_description(user_email, user_name)} - "
+        f"Starting at {date_to_str(from_date)} and up to {date_to_str(to_date)} (inclusive)."
+    )
 
-    uuids = [row[0] for row in rows]
 
-    get_meetings(uuids)
+def download_not_ready_files():
+    """Retry the meetings that are due in the not-ready queue, in batches, and download their recordings."""
+    utils.print_bright("Downloading recordings of meetings that were not ready:")
+
+    with report_progress(), download_pool(
+        CONFIG.MAX_CONCURRENT_DOWNLOADS,
+        CONFIG.MAX_CONCURRENT_DOWNLOADS_PER_USER,
+        progress=progress,
+    ) as pool:
+        # Attempted meetings leave the due items, either removed or rescheduled, so every batch is new.
+        batch = not_ready_meetings.get_due(CONFIG.NOT_READY_BATCH_SIZE)
+        while batch:
+            meeting_uuids_by_user = collections.defaultdict(list)
+            for meeting_uuid, user_email in batch:
+                meeting_uuids_by_user[user_email].append(meeting_uuid)
+
+            # Meetings queued before user emails were recorded are stored at the root of OUTPUT_PATH.
+            for user_email, meeting_uuids in meeting_uuids_by_user.items():
+                meetings = iter_meetings(
+                    meeting_uuids, show_progress=False, user_email=user_email
+                )
+                host_folder = (
+                    get_user_host_folder(user_email) if user_email else CONFIG.OUTPUT_PATH
+                )
+                with tracer.span("user", "user", user=user_email):
+                    download_recordings_from_meetings(
+                        meetings, host_folder, pool, user_email
+                    )
+
+            batch = not_ready_meetings.get_due(CONFIG.NOT_READY_BATCH_SIZE)
+
+    return (pool.file_count, pool.total_size, pool.skipped_count)
 
 
 def get_user_description(user_email, user_name):
@@ -187,65 +459,138 @@ def date_to_str(date):
     return date.strftime("%Y-%m-%d")
 
 
-def get_meeting_uuids(user_email, start_date, end_date):
-    meeting_uuids = []
+def get_meeting_uuids(user_email, start_date, end_date, show_progress=True):
+    return [
+        meeting["uuid"]
+        for meeting in iter_listed_meetings(
+            user_email, start_date, end_date, show_progress
+        )
+    ]
 
+
+def iter_listed_meetings(user_email, start_date, end_date, show_progress=True):
+    """Yield meetings as listed by /users/{email}/recordings, in chronological order."""
+    windows = []
     local_start_date = start_date
     delta = datetime.timedelta(days=29)
+    while local_start_date <= end_date:
+        local_end_date = min(local_start_date + delta, end_date)
+        windows.append((local_start_date, local_end_date))
+        local_start_date = local_end_date + datetime.timedelta(days=1)
+
+    def get_window_meetings(window):
+        local_start_date_str, local_end_date_str = map(date_to_str, window)
+        url = f"https://api.zoom.us/v2/users/{user_email}/recordings?from={local_start_date_str}&to={local_end_date_str}"
+
+        meetings = []
+        with metrics.phase("list_meetings"), tracer.span(
+            "list_meetings",
+            "api",
+            user=user_email,
+            start=local_start_date_str,
+            end=local_end_date_str,
+        ):
+            for page in client.paginate(url):
+                meetings.extend(page["meetings"])
+
+        return reversed(meetings)
 
-    utils.print_bright("Scanning for recorded meetings:")
-    estimated_iterations = math.ceil(
-        (end_date - start_date) / datetime.timedelta(days=30)
+    if show_progress:
+        utils.print_bright("Scanning for recorded meetings:")
+
+    # Windows are listed concurrently, results are still yielded in chronological order.
+    window_meetings = utils.concurrent_map(
+        get_window_meetings, windows, CONFIG.MAX_CONCURRENT_API_REQUESTS
     )
-    with utils.percentage_tqdm(total=estimated_iterations) as progress_bar:
-        while local_start_date <= end_date:
-            local_end_date = min(local_start_date + delta, end_date)
+    for meetings in utils.percentage_tqdm(
+        window_meetings, total=len(windows), disable=not show_progress
+    ):
+        yield from meetings
 
-            local_start_date_str = date_to_str(local_start_date)
-            local_end_date_str = date_to_str(local_end_date)
-            url = f"https://api.zoom.us/v2/users/{user_email}/recordings?from={local_start_date_str}&to={local_end_date_str}"
 
-            ids = []
-            for page in client.paginate(url):
-                ids.extend([meeting["uuid"] for meeting in page["meetings"]])
+def is_listed_meeting_complete(meeting):
+    # Participant audio files are only returned by /meetings/{uuid}/recordings.
+    if CONFIG.INCLUDE_PARTICIPANT_AUDIO and "participant_audio_files" not in meeting:
+        return False
 
-            meeting_uuids.extend(reversed(ids))
-            local_start_date = local_end_date + datetime.timedelta(days=1)
-            progress_bar.update(1)
+    return is_meeting_processed(meeting)
 
-    return meeting_uuids
 
+def is_meeting_processed(meeting):
+    """Whether every file of meeting can be downloaded, files still being processed by Zoom have no size
+    or download URL yet, or a status other than completed."""
+    recording_files = meeting.get("recording_files")
+    participant_audio_files = (
+        (meeting.get("participant_audio_files") or [])
+        if CONFIG.INCLUDE_PARTICIPANT_AUDIO
+        else []
+    )
+    return bool(recording_files) and all(
+        "file_size" in recording_file
+        and recording_file.get("download_url")
+        and recording_file.get("status", "completed") == "completed"
+        for recording_file in recording_files + participant_audio_files
+    )
 
-def get_meetings(meeting_uuids):
-    meetings = []
-    conn = sqlite3.connect("meetings.db")
 
-    if meeting_uuids:
-        utils.print_bright("Scanning for recordings:")
+def get_meetings(meeting_uuids, ordered=True, show_progress=True):
+    return list(iter_meetings(meeting_uuids, ordered, show_progress))
 
-        # Create a cursor object to execute SQL queries
-        cursor = conn.cursor()
-        for meeting_uuid in utils.percentage_tqdm(meeting_uuids):
-            url = f"https://api.zoom.us/v2/meetings/{utils.double_encode(meeting_uuid)}/recordings"
-            try:
-                meetings.append(client.get(url))
-                cursor.execute("DELETE FROM meetings WHERE uuid = ?", (meeting_uuid,))
-            except Exception as e:
-                cursor.execute(
-                    "INSERT OR IGNORE INTO meetings (uuid) VALUES (?)", (meeting_uuid,)
-                )
-                utils.print_bright(
-                    f"Logging error occurred while retrieving recordings for meeting {meeting_uuid}: {e}"
-                )
 
-    conn.commit()
+def iter_meetings(meetings, ordered=True, show_progress=True, user_email=None):
+    """Yield the recordings of meetings as they become available.
+
+    Meetings that fail to be looked up, or whose files are still being processed, are added to the
+    not-ready queue for a later retry. The files that are ready are still downloaded.
+    :param meetings: meeting UUIDs, or listed meetings (see iter_listed_meetings) which are used as they
+    are when they already hold everything needed for downloading and looked up otherwise.
+    :param user_email: email of the user the meetings belong to, stored with not-ready meetings.
+    """
+    if show_progress and utils.length_hint(meetings) != 0:
+        utils.print_bright("Scanning for recordings:")
+
+    def get_meeting(meeting):
+        if isinstance(meeting, dict):
+            if is_listed_meeting_complete(meeting):
+                return meeting["uuid"], meeting, None, False
+            meeting = meeting["uuid"]
 
-    return meetings
+        url = f"https://api.zoom.us/v2/meetings/{utils.double_encode(meeting)}/recordings"
+        try:
+            with metrics.phase("get_meeting_recordings"), tracer.span(
+                "get_meeting_recordings", "api", meeting=meeting
+            ):
+                return meeting, client.get(url), None, True
+        except Exception as e:
+            return meeting, None, e, True
 
+    # Lookups run concurrently, only this thread writes their results to the queue. A meeting is removed
+    # once looked up, downloads of its files that fail add it back (see queue_meeting_on_failure).
+    results = utils.concurrent_map(
+        get_meeting, meetings, CONFIG.MAX_CONCURRENT_API_REQUESTS, ordered
+    )
+    for meeting_uuid, meeting, e, fetched in utils.percentage_tqdm(
+        results, total=utils.length_hint(meetings), disable=not show_progress
+    ):
+        if e is None:
+            if fetched and is_meeting_processed(meeting):
+                not_ready_meetings.remove(meeting_uuid)
+            elif fetched:
+                not_ready_meetings.add_failure(meeting_uuid, user_email, "still processing")
+                utils.print_dim(
+                    f"Recordings of meeting {meeting_uuid} are still being processed, will retry later."
+                )
+            yield meeting
+        else:
+            not_ready_meetings.add_failure(meeting_uuid, user_email, e)
+            utils.print_bright(
+                f"Logging error occurred while retrieving recordings for meeting {meeting_uuid}: {e}"
+            )
 
-def download_recordings_from_meetings(meetings, host_folder):
-    file_count, total_size, skipped_count = 0, 0, 0
 
+def download_recordings_from_meetings(
+    meetings, host_folder, pool, user_email, leases=None
+):
     for meeting in meetings:
         if (
             CONFIG.TOPICS
@@ -300,92 +645,201 @@ def download_recordings_from_meetings(meetings, host_folder):
             )
             file_size = int(recording_file["file_size"])
 
-            if download_recording_file(
-                url, host_folder, file_name, file_size, topic, recording_name
-            ):
-                total_size += file_size
-                file_count += 1
-            else:
-                skipped_count += 1
+            download = functools.partial(
+                download_recording_file,
+                file_id,
+                url,
+                host_folder,
+                file_name,
+                file_size,
+                topic,
+                recording_name,
+                user_email=user_email,
+            )
+            download = queue_meeting_on_failure(
+                download, meeting["uuid"], user_email, file_name
+            )
+            if leases:
+                download = leases.track(user_email, download)
+
+            pool.submit(user_email, download, file_size)
+
+
+def queue_meeting_on_failure(download, meeting_uuid, user_email, file_name):
+    """Wrap download to add its meeting to the not-ready queue when it fails, so the files of the
+    meeting are retried later like those of a meeting whose recordings could not be retrieved."""
 
-    return file_count, total_size, skipped_count
+    def queued_download(position, cancelled=None):
+        downloaded = download(position, cancelled=cancelled)
+        # Cancelled downloads (of a lost lease or an interrupted run) are left to the worker that took the
+        # user over, or the next run.
+        if downloaded is None and not (cancelled and cancelled.is_set()):
+            not_ready_meetings.add_failure(
+                meeting_uuid, user_email, f"Download of {file_name} failed."
+            )
+        return downloaded
+
+    return queued_download
 
 
 def download_recording_file(
-    download_url, host_folder, file_name, file_size, topic, recording_name
+    file_id,
+    download_url,
+    host_folder,
+    file_name,
+    file_size,
+    topic,
+    recording_name,
+    progress_position=None,
+    user_email=None,
+    cancelled=None,
 ):
+    """Download a recording file, returning True when it was downloaded, False when it was skipped
+    and None when it failed. Setting cancelled (a threading.Event) stops the download."""
     if CONFIG.VERBOSE_OUTPUT:
         print()
         utils.print_dim(f"URL: {download_url}")
 
-    file_path = create_path(host_folder, file_name, topic, recording_name)
-
-    if (
-        os.path.exists(file_path)
-        and abs(os.path.getsize(file_path) - file_size)
-        <= CONFIG.FILE_SIZE_MISMATCH_TOLERANCE
+    # Files recorded in the manifest are skipped without any file system calls.
+    copies = manifest.get(file_id)
+    file_path = get_file_path(host_folder, file_name, topic, recording_name)
+    if any(
+        path == file_path and is_size_within_tolerance(size, file_size)
+        for path, size, _ in copies
     ):
         utils.print_dim(f"Skipping existing file: {file_name}")
         return False
-    elif os.path.exists(file_path):
+
+    existing_size = sink.get_size(file_path)
+    if existing_size is not None and is_size_within_tolerance(existing_size, file_size):
+        utils.print_dim(f"Skipping existing file: {file_name}")
+        manifest.add(file_id, file_path, existing_size)
+        return False
+    elif existing_size is not None:
         utils.print_dim_red(f"Deleting corrupt file: {file_name}")
-        os.remove(file_path)
+        sink.remove(file_path)
+
+    if CONFIG.DEDUPLICATE_FILES and link_copy(file_id, copies, file_path, file_size):
+        utils.print_dim(f"Linked existing copy: {file_name}")
+        return False
 
     utils.print_bright(f"Downloading: {file_name}")
-    utils.wait_for_disk_space(
-        file_size, CONFIG.OUTPUT_PATH, CONFIG.MINIMUM_FREE_DISK, interval=5
-    )
-    tmp_file_path = file_path + ".tmp"
-
-    if download_with_retry(
-        download_url,
-        tmp_file_path,
-        file_size,
-        CONFIG.VERBOSE_OUTPUT,
-        CONFIG.FILE_SIZE_MISMATCH_TOLERANCE,
+
+    segments = 1
+    if (
+        CONFIG.SEGMENTED_DOWNLOAD_THRESHOLD is not None
+        and file_size >= CONFIG.SEGMENTED_DOWNLOAD_THRESHOLD
     ):
-        os.rename(tmp_file_path, file_path)
+        segments = CONFIG.DOWNLOAD_SEGMENTS
+
+    # Time in the download span before its transfer span is spent waiting for disk space.
+    with tracer.span(
+        "download", "download", file=file_name, size=file_size
+    ), sink.open(file_path, file_size) as target:
+        started_at = time.monotonic()
+        with tracer.span("transfer", "download", segments=segments):
+            sha256 = download_with_retry(
+                download_url,
+                target,
+                file_size,
+                CONFIG.VERBOSE_OUTPUT,
+                CONFIG.FILE_SIZE_MISMATCH_TOLERANCE,
+                progress_position=progress_position,
+                segments=segments,
+                cancelled=cancelled,
+            )
+        finished_at = time.monotonic()
+        download_seconds = finished_at - started_at
+        metrics.add_phase_time("transfer", started_at, finished_at)
+
+        # Only a download that passed the size check is stored.
+        if sha256:
+            stored_size = target.commit()
+
+    if sha256:
+        metrics.observe_download(user_email, file_size, download_seconds)
+        if CONFIG.DEDUPLICATE_FILES:
+            link_duplicate(file_path, sha256)
+        manifest.add(file_id, file_path, stored_size, sha256)
         return True
     else:
-        return False
+        return None
+
+
+def link_copy(file_id, copies, file_path, file_size):
+    """Hard-link file_path to an existing copy of the same recording file (e.g. from another user's folder)."""
+    for path, size, sha256 in copies:
+        if is_size_within_tolerance(size, file_size) and sink.link(path, file_path):
+            manifest.add(file_id, file_path, size, sha256)
+            return True
+
+    return False
 
-    os.rename(tmp_file_path, file_path)
 
-    return True
+def link_duplicate(file_path, sha256):
+    """Replace the downloaded file_path with a hard link to an earlier file with the same content."""
+    for path, _ in manifest.find_by_hash(sha256):
+        if path != file_path and sink.relink(path, file_path):
+            return
+
+
+def is_size_within_tolerance(size, expected_size):
+    return abs(size - expected_size) <= CONFIG.FILE_SIZE_MISMATCH_TOLERANCE
 
 
 def download_with_retry(
     download_url,
-    tmp_file_path,
+    target,
     file_size,
     verbose_output,
     file_size_mismatch_tolerance,
     max_retries=10,
+    progress_position=None,
+    segments=1,
+    cancelled=None,
 ):
     retries = 0
     while retries < max_retries:
         try:
-            client.do_with_token(
-                lambda t: utils.download_with_progress(
+            return client.do_with_token(
+                lambda t: target.download(
                     f"{download_url}?access_token={t}",
-                    tmp_file_path,
                     file_size,
                     verbose_output,
                     file_size_mismatch_tolerance,
+                    position=progress_position,
+                    segments=segments,
+                    session=client.session,
+                    bandwidth=bandwidth,
+                    chunk_size=CONFIG.DOWNLOAD_CHUNK_SIZE,
+                    fsync=CONFIG.FSYNC_DOWNLOADS,
+                    timeout=(CONFIG.HTTP_CONNECT_TIMEOUT, CONFIG.HTTP_READ_TIMEOUT),
+                    min_speed=CONFIG.STALLED_DOWNLOAD_SPEED,
+                    stall_window=CONFIG.STALLED_DOWNLOAD_WINDOW,
+                    on_progress=progress.add_bytes,
+                    cancelled=cancelled,
                 )
-            )
-            return True  # Download succeeded, no need to retry
+            )  # Download succeeded, no need to retry
+        except utils.DownloadCancelledError:
+            utils.print_dim_red("Download cancelled.")
+            return None
         except Exception as e:
-            print(f"Download failed: {e}")
+            utils.print_dim_red(f"Download failed: {e}")
+            metrics.increment(
+                "download_stalls"
+                if isinstance(e, utils.DownloadStalledError)
+                else "download_errors"
+            )
             retries += 1
             if retries < max_retries:
-                print(f"Retrying ({retries}/{max_retries}) in 5 seconds...")
+                utils.print_dim(f"Retrying ({retries}/{max_retries}) in 5 seconds...")
                 time.sleep(5)
-    print("Max retries reached, download failed.")
-    return False
+    utils.print_dim_red("Max retries reached, download failed.")
+    metrics.increment("failed_downloads")
+    return None
 
 
-def create_path(host_folder, file_name, topic, recording_name):
+def get_file_path(host_folder, file_name, topic, recording_name):
     folder_path = host_folder
 
     if CONFIG.GROUP_BY_TOPIC:
@@ -393,14 +847,14 @@ def create_path(host_folder, file_name, topic, recording_name):
     if CONFIG.GROUP_BY_RECORDING:
         folder_path = os.path.join(folder_path, recording_name)
 
-    os.makedirs(folder_path, exist_ok=True)
-
     return os.path.join(folder_path, file_name)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        setup()
+        with run_profiler(CONFIG.PROFILE_PATH, CONFIG.PROFILE_SORT):
+            main()
     except AttributeError as error:
         if isinstance(error.obj, ModuleType) and error.obj.__name__ == "config":
             print()
@@ -421,6 +875,16 @@ if __name__ == "__main__":
             utils.print_dim_red(traceback.format_exc())
 
     except KeyboardInterrupt:
+        metrics.outcome = "interrupted"
         print()
         utils.print_bright_red("Interrupted by the user")
         exit(1)
+
+    finally:
+        if tracer:
+            try:
+                write_run_report()
+            except Exception as error:
+                utils.print_dim_red(f"Failed to write the run report: {error}")
+        if database:
+            database.close()
@@ -1,26 +1,83 @@
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 import utils
+from rate_limiter import DEFAULT_RATES, get_endpoint, rate_limiter
+
+
+class timeout_http_adapter(HTTPAdapter):
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
 
 
 class zoom_client:
-    def __init__(self, account_id: str, client_id: str, client_secret: str, PAGE_SIZE: int = 300):
+    def __init__(
+        self, account_id: str, client_id: str, client_secret: str, PAGE_SIZE: int = 300,
+        pool_size: int = 10, connect_timeout: float = 10, read_timeout: float = 60,
+        token_refresh_margin: float = 300, rate_limits: dict = DEFAULT_RATES, metrics=None
+    ):
         self.account_id = account_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.PAGE_SIZE = PAGE_SIZE
         self.cached_token = None
+        self.token_expires_at = 0
+        self.token_refresh_margin = token_refresh_margin
+        self.token_lock = threading.Lock()
+
+        # One keep-alive connection pool per host, shared by API calls and file downloads on all threads.
+        self.session = requests.Session()
+        adapter = timeout_http_adapter(
+            (connect_timeout, read_timeout), pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.rate_limiter = rate_limiter(rate_limits)
+        self.metrics = metrics
 
     def get(self, url):
-        return self._get_with_token(lambda t: requests.get(url=url, headers=self.get_headers(t))).json()
+        return self._get_with_token(
+            lambda t: self.rate_limiter.request(url, lambda: self._send(url, t))
+        ).json()
+
+    def _send(self, url, token):
+        return self._observe(url, lambda: self.session.get(url=url, headers=self.get_headers(token)))
+
+    def _observe(self, url, send):
+        """Send a request, recording its latency and status in metrics (a run_metrics) when given."""
+        if not self.metrics:
+            return send()
+
+        started_at = time.monotonic()
+        status = 'error'
+        try:
+            response = send()
+            status = response.status_code
+            return response
+        finally:
+            self.metrics.observe_request(get_endpoint(url), time.monotonic() - started_at, status)
+
+    def _count(self, counter):
+        if self.metrics:
+            self.metrics.increment(counter)
 
     def _get_with_token(self, get):
-        if self.cached_token:
-            response = get(self.cached_token)
-        
-        if not self.cached_token or response.status_code == 401:
-            self.cached_token = self.fetch_token()
-            response = get(self.cached_token)
+        token = self.get_token()
+        response = get(token)
+
+        if response.status_code == 401:
+            self._count('rejected_tokens')
+            response = get(self.refresh_token(token))
 
         if not response.ok:
             raise Exception(f'{response.status_code} {response.text}')
@@ -32,13 +89,34 @@ class zoom_client:
             'grant_type': 'account_credentials',
             'account_id': self.account_id
         }
-        response = requests.post(
-            'https://api.zoom.us/oauth/token', auth=(self.client_id, self.client_secret),  data=data
+        url = 'https://api.zoom.us/oauth/token'
+        response = self._observe(
+            url, lambda: self.session.post(url, auth=(self.client_id, self.client_secret),  data=data)
         ).json()
         if 'access_token' not in response:
             raise Exception(f'Unable to fetch access token: {response["reason"]} - verify your credentials.')
 
-        return response['access_token']  
+        return response['access_token'], response.get('expires_in', 3600)
+
+    def get_token(self):
+        """Return the cached token, fetching a new one if it is missing or about to expire."""
+        if self.cached_token and time.monotonic() < self.token_expires_at - self.token_refresh_margin:
+            return self.cached_token
+
+        return self.refresh_token(self.cached_token)
+
+    def refresh_token(self, stale_token):
+        """Replace stale_token with a new token.
+
+        Callers that find the same stale token at the same time wait for a single fetch and share its result.
+        """
+        with self.token_lock:
+            if self.cached_token == stale_token:
+                fetched_at = time.monotonic()
+                self.cached_token, expires_in = self.fetch_token()
+                self.token_expires_at = fetched_at + expires_in
+
+            return self.cached_token
     
     def get_headers(self, token):
         return {
@@ -72,18 +150,12 @@ class zoom_client:
         return __paginate_iter(self, url)
     
     def do_with_token(self, do):
-        def do_as_get(token):
-            test_url = 'https://api.zoom.us/v2/users/me/recordings'
-
-            test_response = requests.get(test_url, headers=self.get_headers(token))
-            if test_response.ok:
-                try:
-                    do(token)
-                except:
-                    test_response = requests.get(test_url, headers=self.get_headers(token))
-                    if test_response.ok:
-                        raise
-
-            return test_response
-            
-        self._get_with_token(lambda t: do_as_get(t))
\ No newline at end of file
+        token = self.get_token()
+        try:
+            return do(token)
+        except requests.HTTPError as error:
+            if error.response is None or error.response.status_code not in (401, 403):
+                raise
+
+        self._count('rejected_tokens')
+        return do(self.refresh_token(token))